@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# This file is part of tcollector.
+# Copyright (C) 2014  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+"""Microbenchmarks for the hot paths of tcollector.
+
+Usage: benchmarks.py [-n LINES] [--corpus FILE] [benchmark ...]
+Runs all the benchmarks when none is named on the command line."""
+
+import errno
+import os
+import re
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import tcollector
+
+
+# Output recorded from a few of the collectors in collectors/0, used by the
+# benchmarks unless --corpus points at a bigger recording.
+CORPUS = """\
+proc.stat.cpu 1400000000 2351712 type=user cpu=0
+proc.stat.cpu 1400000000 4921 type=nice cpu=0
+proc.stat.cpu 1400000000 718263 type=system cpu=0
+proc.stat.cpu 1400000000 89231445 type=idle cpu=0
+proc.stat.cpu 1400000000 10362 type=iowait cpu=0
+proc.stat.intr 1400000000 2961307451
+proc.stat.ctxt 1400000000 5362183014
+proc.meminfo.memfree 1400000000 1893476
+proc.meminfo.buffers 1400000000 276324
+proc.vmstat.pgpgin 1400000000 8924132
+proc.loadavg.1min 1400000000 0.42
+proc.loadavg.runnable 1400000000 2
+proc.interrupts 1400000000 38918270 type=LOC cpu=3
+iostat.disk.read_requests 1400000000 832913 dev=sda
+iostat.disk.msec_read 1400000000 2131712 dev=sda
+iostat.disk.write_sectors 1400000000 93727192 dev=sda1
+iostat.disk.await 1400000000 4.27 dev=sda
+proc.net.bytes 1400000000 93871273264 iface=eth0 direction=in
+proc.net.packets 1400000000 73562891 iface=eth0 direction=out
+proc.net.dropped 1400000000 0 iface=eth0 direction=in
+net.sockstat.num_sockets 1400000000 393 type=tcp
+net.stat.tcp.retransmit 1400000000 3187 type=fast
+proc.net.tcp 1400000000 12 user=hbase port=60020 state=established endpoint=internal
+df.bytes.free 1400000000 43891273728 mount=/ fstype=ext4
+mysql.innodb.buffer_pool_pages_free 1400000000 1023 schema=main
+jvm.memory.heap.used 1400000000 523182944 type=heap service=hbase_regionserver
+hbase.regionserver.requests 1400000000 9123.5 region=all service=hbase_regionserver
+"""
+
+
+def load_corpus(options, n):
+    """Returns n lines of recorded collector output, repeated as needed."""
+    if options.corpus:
+        corpus = open(options.corpus).read()
+    else:
+        corpus = CORPUS
+    corpus = [line for line in corpus.splitlines() if line.strip()]
+    return (corpus * (n // len(corpus) + 1))[:n]
+
+
+def make_lines(n):
+    """Returns n lines that look like what procstats would output."""
+    ts = int(time.time())
+    return ['proc.stat.cpu %d %d type=user cpu=%d' % (ts, i, i % 64)
+            for i in xrange(n)]
+
+
+class FakeProc(object):
+    """Looks enough like a subprocess.Popen for Collector.read."""
+
+    def __init__(self):
+        rout, self.wout = os.pipe()
+        rerr, self.werr = os.pipe()
+        tcollector.set_nonblocking(rout)
+        tcollector.set_nonblocking(rerr)
+        self.stdout = os.fdopen(rout, 'rb', 0)
+        self.stderr = os.fdopen(rerr, 'rb', 0)
+
+    def close(self):
+        for fd in (self.wout, self.werr):
+            os.close(fd)
+        self.stdout.close()
+        self.stderr.close()
+
+
+class LegacyCollector(tcollector.Collector):
+    """A Collector with the read() we had before LineBuffer, to compare."""
+
+    def __init__(self, *args):
+        super(LegacyCollector, self).__init__(*args)
+        self.buffer = ''
+
+    def read(self):
+        try:
+            self.buffer += self.proc.stdout.read()
+        except IOError, (err, msg):
+            if err != errno.EAGAIN:
+                raise
+        while self.buffer:
+            idx = self.buffer.find('\n')
+            if idx == -1:
+                break
+            line = self.buffer[0:idx].strip()
+            if line:
+                self.datalines.append(line)
+                self.last_datapoint = int(time.time())
+            self.buffer = self.buffer[idx+1:]
+
+
+def time_collector_read(cls, lines):
+    """Feeds one burst of lines through cls.read() and returns lines/sec."""
+    col = cls('bench', 0, 'bench')
+    col.proc = FakeProc()
+    data = ''.join(line + '\n' for line in lines)
+
+    def write():
+        os.write(col.proc.wout, data)  # Blocks until everything is read.
+    writer = threading.Thread(target=write)
+
+    received = 0
+    start = time.time()
+    writer.start()
+    while received < len(lines):
+        select.select([col.proc.stdout], [], [])
+        for line in col.collect():
+            received += 1
+    elapsed = time.time() - start
+    writer.join()
+    col.proc.close()
+    return received / elapsed
+
+
+def bench_collector_read(options):
+    """Collector.read on a single burst of lines."""
+    lines = make_lines(options.lines)
+    report('collector_read legacy', time_collector_read(LegacyCollector, lines))
+    report('collector_read', time_collector_read(tcollector.Collector, lines))
+
+
+def legacy_parse(line):
+    """ReaderThread.process_line's parsing before we had the LineParser."""
+    parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
+                      '(\d+)\s+'               # Timestamp.
+                      '(\S+?)'                 # Value (int or float).
+                      '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
+                      line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed.groups()
+    return metric, int(timestamp), value, tags
+
+
+def time_parse(parse, lines, repeat):
+    """Runs parse() over all the lines repeat times and returns the best
+       lines/sec, the others being slowed down by whatever else runs."""
+    best = 0
+    for i in xrange(repeat):
+        start = time.time()
+        for line in lines:
+            parse(line)
+        best = max(best, len(lines) / (time.time() - start))
+    return best
+
+
+def bench_line_parser(options):
+    """LineParser.parse over the corpus."""
+    lines = load_corpus(options, options.lines)
+    report('line_parser legacy',
+           time_parse(legacy_parse, lines, options.repeat))
+    for mode in tcollector.LineParser.MODES:
+        parser = tcollector.LineParser(mode)
+        report('line_parser ' + mode,
+               time_parse(parser.parse, lines, options.repeat))
+
+
+# An interval collector that does nothing but the usual imports.
+SPAWN_COLLECTOR = """\
+#!/usr/bin/env python
+import json
+import socket
+import time
+from collectors.lib import utils
+print 'bench.spawn %d 1' % time.time()
+"""
+
+
+def time_spawn(spawn, runs):
+    """Starts a collector runs times, and returns the average number of
+       seconds until it's done."""
+    start = time.time()
+    for i in xrange(runs):
+        proc = spawn()
+        while True:
+            select.select([proc.stdout], [], [])
+            if not os.read(proc.stdout.fileno(), 4096):
+                break
+        proc.wait()
+    return (time.time() - start) / runs
+
+
+def bench_spawn(options):
+    """Starting an interval collector, as a subprocess or from a forkserver."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(tmpdir, 'collectors', '1'))
+        libdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'collectors')
+        for name in ('__init__.py', 'lib'):
+            os.symlink(os.path.join(libdir, name),
+                       os.path.join(tmpdir, 'collectors', name))
+        filename = os.path.join(tmpdir, 'collectors', '1', 'spawn.py')
+        with open(filename, 'w') as f:
+            f.write(SPAWN_COLLECTOR)
+        os.chmod(filename, 0755)
+        tcollector.setup_python_path(os.path.join(tmpdir, 'collectors'))
+        col = tcollector.Collector('spawn.py', 1, filename)
+
+        def popen():
+            return subprocess.Popen(filename, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True,
+                                    preexec_fn=os.setsid)
+        report_latency('spawn subprocess', time_spawn(popen, options.spawns))
+
+        server = tcollector.ForkServer()
+        server.start()
+        try:
+            report_latency('spawn forkserver',
+                           time_spawn(lambda: server.spawn(col),
+                                      options.spawns))
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def legacy_send_data(sender, tags):
+    """SenderThread.send_data's string building before the GlobalTags."""
+    def add_tags_to_line(line):
+        for tag, value in tags:
+            if ' %s=' % tag not in line:
+                line += ' %s=%s' % (tag, value)
+        return line
+    out = "".join("put %s\n" % add_tags_to_line(line) for line in sender.sendq)
+    sender.tsd.sendall(out)
+    sender.sendq = []
+
+
+def time_send_data(send, lines, tag):
+    """Tags the lines with tag(), queues them up and sends them to a socket
+       with send(sender), and returns lines/sec."""
+    sender = tcollector.SenderThread(None, False, [('tsd', 4242)], False,
+                                     {}, 0)
+    sender.tsd, peer = socket.socketpair()
+
+    def drain():
+        while peer.recv(1 << 20):
+            pass
+    reader = threading.Thread(target=drain)
+    reader.start()
+    start = time.time()
+    sender.sendq = tag()
+    send(sender)
+    elapsed = time.time() - start
+    sender.tsd.close()
+    reader.join()
+    peer.close()
+    return len(lines) / elapsed
+
+
+def bench_send_data(options):
+    """SenderThread.send_data on batches of a tenth of -n lines and -n lines,
+       global tags included."""
+    tags = {'host': 'web042.example.com', 'dc': 'ams1'}
+    global_tags = tcollector.GlobalTags(tags)
+    parser = tcollector.LineParser()
+    for n in (options.lines // 10, options.lines):
+        lines = load_corpus(options, n)
+        parsed = [parser.parse(line)[3] for line in lines]
+        report('send_data legacy %d' % n, time_send_data(
+            lambda sender: legacy_send_data(sender, global_tags.items),
+            lines, lambda: list(lines)))
+        # now the ReaderThread adds the tags, count it in.
+        report('send_data %d' % n, time_send_data(
+            tcollector.SenderThread.send_data, lines,
+            lambda: [line + global_tags.suffix_for(tags)
+                     for line, tags in zip(lines, parsed)]))
+
+
+BENCHMARKS = [
+    ('collector_read', bench_collector_read),
+    ('line_parser', bench_line_parser),
+    ('spawn', bench_spawn),
+    ('send_data', bench_send_data),
+]
+
+
+def report(name, lines_per_sec):
+    print '%-40s %12.0f lines/sec' % (name, lines_per_sec)
+
+
+def report_latency(name, seconds):
+    print '%-40s %12.2f ms' % (name, seconds * 1000)
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--lines', dest='lines', type='int',
+                      default=100000, metavar='LINES',
+                      help='Number of lines per burst. default=%default')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+                      help='Number of runs to keep the best of, for the '
+                           'benchmarks that are quick. default=%default')
+    parser.add_option('--spawns', dest='spawns', type='int', default=50,
+                      help='Number of collectors to start in the spawn '
+                           'benchmark. default=%default')
+    parser.add_option('--corpus', dest='corpus', metavar='FILE',
+                      help='File with recorded collector output to use '
+                           'instead of the built-in sample.')
+    (options, args) = parser.parse_args(args=argv[1:])
+    for name, bench in BENCHMARKS:
+        if not args or name in args:
+            bench(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -42,35 +42,53 @@ FIELDS = ("bytes", "packets", "errs", "dropped",
           "fifo.errs", "collisions", "carrier.errs", "compressed")
 
 
-def main():
-    """ifstat main loop"""
-
-    f_netdev = open("/proc/net/dev")
-    utils.drop_privileges()
+def read_stats(f_netdev):
+    """Returns the lines of stats of the network interfaces right now."""
 
     # We just care about ethN and emN interfaces.  We specifically
     # want to avoid bond interfaces, because interface
     # stats are still kept on the child interfaces when
     # you bond.  By skipping bond we avoid double counting.
+    f_netdev.seek(0)
+    ts = int(time.time())
+    lines = []
+    for line in f_netdev:
+        m = re.match("\s+(eth\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
+                     "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)", line)
+        if not m:
+            continue
+        intf = m.group(1)
+        stats = m.group(2).split(None)
+
+        def direction(i):
+            if i >= 8:
+                return "out"
+            return "in"
+        for i in xrange(16):
+            lines.append("proc.net.%s %d %s iface=%s direction=%s"
+                         % (FIELDS[i], ts, stats[i], intf, direction(i)))
+    return lines
+
+
+def collect():
+    """Yields the stats of the network interfaces every `interval` seconds.
+       tcollector can run this directly in its own process (--in-process)."""
+
+    f_netdev = open("/proc/net/dev")
     while True:
-        f_netdev.seek(0)
-        ts = int(time.time())
-        for line in f_netdev:
-            m = re.match("\s+(eth\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
-                         "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)", line)
-            if not m:
-                continue
-            intf = m.group(1)
-            stats = m.group(2).split(None)
-
-            def direction(i):
-                if i >= 8:
-                    return "out"
-                return "in"
-            for i in xrange(16):
-                print("proc.net.%s %d %s iface=%s direction=%s"
-                      % (FIELDS[i], ts, stats[i], intf, direction(i)))
+        for line in read_stats(f_netdev):
+            yield line
+        time.sleep(interval)
+
 
+def main():
+    """ifstat main loop"""
+
+    f_netdev = open("/proc/net/dev")
+    utils.drop_privileges()
+    while True:
+        for line in read_stats(f_netdev):
+            print(line)
         sys.stdout.flush()
         time.sleep(interval)
 
@@ -20,6 +20,12 @@
 # every single data point.  For instance if you have multiple different
 # pools or clusters of machines, you might wanna lookup the name of the
 # pool or cluster the current host belongs to and add it to the tags.
+# The priority of the collectors is in options.priorities, a dictionary
+# that maps collector names to their priority (0 for those not in it).  The
+# data of the collectors with a higher priority is sent first, and dropped
+# last when tcollector can't keep up.  For instance to keep the host metrics
+# flowing when a chatty collector fills up the queue:
+#   options.priorities.update({'procstats.py': 2, 'iostat.py': 2})
 # Throwing an exception here will cause the tcollector to die before it
 # starts doing any work.
 # Python files in this directory that don't have an "onload" function
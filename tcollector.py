@@ -21,22 +21,34 @@
 #
 
 import atexit
+import bisect
+import ctypes
+import ctypes.util
 import errno
 import fcntl
+import hashlib
+import heapq
+import httplib
+import io
+import json
 import logging
+import math
 import os
 import random
 import re
+import runpy
+import select
 import signal
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import traceback
+import zlib
 from logging.handlers import RotatingFileHandler
-from Queue import Queue
-from Queue import Empty
-from Queue import Full
 from optparse import OptionParser
 
 
@@ -55,8 +67,76 @@ MAX_REASONABLE_TIMESTAMP = 1600000000  # Good until September 2020 :)
 # How long to wait for datapoints before assuming
 # a collector is dead and restarting it
 ALLOWED_INACTIVITY_TIME = 600  # seconds
+# How often to look for new or updated collectors and config modules.
+SCAN_INTERVAL = 15  # seconds
+# How often to do it anyway when inotify tells us about the changes, in case
+# it misses some (e.g. changes made by another host on NFS).
+FULL_SCAN_INTERVAL = 600  # seconds
+# Don't restart a long-running collector that exited more often than that.
+MIN_RESPAWN_INTERVAL = 1  # seconds
+# How long to wait for the ReaderThread to read what a collector wrote before
+# it exited, in case something else keeps its pipes open.
+PIPE_DRAIN_TIMEOUT = 5  # seconds
 MAX_SENDQ_SIZE = 10000
+# Default flush policy of the SenderThread (see --max-send-latency and
+# --max-batch-bytes).
+DEFAULT_MAX_SEND_LATENCY = 5  # seconds
+DEFAULT_MAX_BATCH_BYTES = 1024 * 1024
+# How much data to hand to the kernel at once in telnet mode.
+SEND_CHUNK_BYTES = 64 * 1024
+# How many data points to send per request to the HTTP API of the TSD.
+DEFAULT_HTTP_BATCH_SIZE = 50
+# Defaults for the DiskSpool (see --spool-dir).
+DEFAULT_SPOOL_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SPOOL_REPLAY_RATE = 5000  # lines per second
 MAX_READQ_SIZE = 100000
+# How much memory the lines waiting to be sent can use (see
+# --max-queue-bytes), and how much each line costs on top of its length
+# (the str object and its slot in a list, on 64-bit CPython).
+DEFAULT_MAX_QUEUE_BYTES = 32 * 1024 * 1024
+MAX_SENDQ_BYTES = 4 * 1024 * 1024
+QUEUED_LINE_OVERHEAD = 48
+# Which lines to drop when the reader queue is full (see --drop-policy).
+DROP_POLICIES = ('newest', 'oldest', 'priority')
+# Maps the names of the collectors to their priority (see --priority).
+PRIORITIES = {}
+# How long to use the addresses of a TSD before resolving its name again.
+# getaddrinfo doesn't tell us the TTL of the DNS records.
+DEFAULT_DNS_TTL = 300  # seconds
+# How many metrics to keep separate counts of rejected data points for.
+MAX_REJECTED_METRICS = 1000
+# Finds the metric name in the errors the TSD answers our puts with, like:
+# put: unknown metric: No such name for 'metrics': 'foo.bar'
+TSD_ERROR_METRIC_RE = re.compile(r"'([^']+)'\s*$")
+INVALID_TAG_CHARS_RE = re.compile(r'[^-_./a-zA-Z0-9]')
+# How many distinct metric names and tag strings to share between the
+# collectors and the threads (see InternTable).
+MAX_INTERN_SIZE = 100000
+# The ReaderPoller used to wait for output from the collectors, or None if
+# the ReaderThread has to fall back to polling every collector once a second.
+POLLER = None
+# Whether to run the Python collectors that have a collect() function in
+# threads of tcollector instead of subprocesses (see --in-process).
+IN_PROCESS = False
+# The ForkServer that starts the interval collectors, if --forkserver.
+FORKSERVER = None
+# The pipe that wakes up the main loop when a collector exits (see
+# setup_wakeup_pipe).
+WAKEUP_PIPE = None
+# The CgroupManager that limits the resources of the collectors, if --cgroup.
+CGROUPS = None
+# How many lines of stderr per second, and in a burst, to log per collector
+# (see --stderr-rate and --stderr-burst).
+STDERR_RATE = 10
+STDERR_BURST = 100
+# How often to log how many lines of stderr we suppressed.
+STDERR_SUMMARY_INTERVAL = 60  # seconds
+# Heap of (time, collector name) of the next runs of the interval collectors.
+SCHEDULE = []
+# How to schedule the interval collectors (see --schedule).
+SCHEDULE_MODES = ('interval', 'aligned', 'jittered')
+SCHEDULE_MODE = 'interval'
 
 
 def register_collector(collector):
@@ -65,30 +145,1178 @@ def register_collector(collector):
     assert isinstance(collector, Collector), "collector=%r" % (collector,)
     # store it in the global list and initiate a kill for anybody with the
     # same name that happens to still be hanging around
-    if collector.name in COLLECTORS:
-        col = COLLECTORS[collector.name]
+    col = COLLECTORS.get(collector.name)
+    if col is not None:
         if col.proc is not None:
             LOG.error('%s still has a process (pid=%d) and is being reset,'
                       ' terminating', col.name, col.proc.pid)
             col.shutdown()
 
     COLLECTORS[collector.name] = collector
+    if col is not None:
+        collector.usage = col.usage
+        collector.stderr_bucket = col.stderr_bucket
+        collector.stderr_suppressed = col.stderr_suppressed
+    if collector.interval:
+        if col is not None and col.interval == collector.interval:
+            # keep the run that's already in the SCHEDULE.
+            collector.next_run = col.next_run
+        else:
+            schedule_collector(collector, first_run_time(collector))
+
+
+class InternTable(object):
+    """A bounded table of the metric names and tag strings we've seen, so
+       that identical series keys coming from any collector or going through
+       any thread share a single string object.
+
+       Strings are kept in two generations of plain dicts: strings are looked
+       up in both and always moved to the young one.  When the young
+       generation is full it becomes the old one, and whatever was in the old
+       generation and wasn't used since is forgotten.  This approximates LRU
+       eviction without any bookkeeping on the hot path.  Each string is
+       stored with its size, so that counting the bytes saved on a hit is
+       just an addition.  The counters are updated without a lock, so
+       they're only approximately right."""
+
+    def __init__(self, max_size):
+        self.max_generation_size = max(1, max_size // 2)
+        self.young = {}  # Maps a string to (shared string, size).
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0  # Memory freed by handing out shared strings.
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def __call__(self, string):
+        """Returns the shared copy of the given string."""
+        entry = self.young.get(string)
+        if entry is None:
+            entry = self.old.pop(string, None)
+            if entry is None:
+                self.misses += 1
+                if len(self.young) >= self.max_generation_size:
+                    self.old = self.young
+                    self.young = {}
+                self.young[string] = (string, sys.getsizeof(string))
+                return string
+            self.young[string] = entry
+        self.hits += 1
+        shared, size = entry
+        if shared is not string:
+            self.bytes_saved += size
+        return shared
+
+    def hit_rate(self):
+        """Returns the percentage of lookups that found a shared string."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0
+        return self.hits * 100 // lookups
+
+
+# The InternTable shared by all the collectors and threads.
+INTERN = InternTable(MAX_INTERN_SIZE)
+
+
+class Histogram(object):
+    """A histogram of values with fixed bucket boundaries, reported as
+       cumulative counters (like the number of values <= each boundary)."""
+
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Last one is +Inf.
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self, name):
+        """Returns the (name, tags, value) tuples to report for this
+           histogram, in the format used by SenderThread.verify_conn."""
+        strs = [(name + '.count', '', self.count),
+                (name + '.sum', '', int(self.sum))]
+        total = 0
+        for bound, count in zip(self.bounds + ['inf'], self.counts):
+            total += count
+            strs.append((name + '.bucket', 'le=%s' % bound, total))
+        return strs
+
+
+# How late the interval collectors start compared to their schedule, in ms.
+SCHEDULE_LAG = Histogram([10, 100, 500, 1000, 5000, 15000, 60000])
+
+
+class DiskSpool(object):
+    """An append-only spool of lines on disk, where the data that doesn't
+       fit in memory goes while we can't send it to any TSD.
+
+       The spool is a directory of numbered segment files.  Lines are
+       appended to the newest segment, which is rotated once it reaches
+       segment_bytes, and read back from the oldest one, which is deleted
+       once it has been entirely read.  When the spool would exceed
+       max_bytes the oldest segments are thrown away.  The segments left
+       over by a previous run are read back too."""
+
+    FSYNC_POLICIES = ('always', 'segment', 'never')
+
+    def __init__(self, directory, max_bytes, segment_bytes, fsync='segment'):
+        """Constructor.
 
+        Args:
+          directory: Where to store the segments, created if needed.
+          max_bytes: How much disk space the spool can use at most.
+          segment_bytes: Size after which we start a new segment.
+          fsync: When to fsync the segments: after every write ('always'),
+            when a segment is complete ('segment') or 'never'.
+        """
+        assert fsync in self.FSYNC_POLICIES, 'invalid fsync policy %r' % fsync
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[6:]) for name in os.listdir(directory)
+                               if name.startswith('spool.')
+                               and name[6:].isdigit())
+        self.bytes = sum(os.path.getsize(self.path(seq))
+                         for seq in self.segments)
+        self.bytes_evicted = 0  # Data thrown away to stay within max_bytes.
+        self.write_file = None  # The segment we're appending to.
+        self.read_file = None   # The segment we're reading from.
+        if self.segments:
+            LOG.info('Found %d bytes of data spooled in %s', self.bytes,
+                     directory)
+
+    def path(self, seq):
+        return os.path.join(self.directory, 'spool.%010d' % seq)
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _rotate(self):
+        """Starts a new segment to append to."""
+        if self.write_file is not None:
+            if self.fsync != 'never':
+                self._sync(self.write_file)
+            self.write_file.close()
+        seq = self.segments and self.segments[-1] + 1 or 0
+        self.segments.append(seq)
+        self.write_file = open(self.path(seq), 'ab')
+
+    def _delete_oldest(self):
+        seq = self.segments.pop(0)
+        if self.read_file is not None:
+            self.read_file.close()
+            self.read_file = None
+        if self.write_file is not None and not self.segments:
+            self.write_file.close()
+            self.write_file = None
+        path = self.path(seq)
+        size = os.path.getsize(path)
+        os.unlink(path)
+        self.bytes -= size
+        return size
+
+    def append(self, lines):
+        """Appends the given lines to the spool.
+
+        Returns: Whether the lines were written, which isn't the case if
+          they alone exceed the disk budget.
+        """
+        data = '\n'.join(lines) + '\n'
+        self.lock.acquire()
+        try:
+            # Make room by throwing away the oldest data we have, but never
+            # the segment we're writing to.
+            while (self.bytes + len(data) > self.max_bytes
+                   and len(self.segments) > 1):
+                self.bytes_evicted += self._delete_oldest()
+            if self.bytes + len(data) > self.max_bytes:
+                return False
+            if (self.write_file is None
+                or self.write_file.tell() >= self.segment_bytes):
+                self._rotate()
+            self.write_file.write(data)
+            if self.fsync == 'always':
+                self._sync(self.write_file)
+            else:
+                self.write_file.flush()
+            self.bytes += len(data)
+            return True
+        finally:
+            self.lock.release()
 
-class ReaderQueue(Queue):
-    """A Queue for the reader thread"""
+    def read(self, max_lines):
+        """Reads (and removes) up to max_lines lines from the spool."""
+        lines = []
+        self.lock.acquire()
+        try:
+            while self.segments and len(lines) < max_lines:
+                if self.read_file is None:
+                    self.read_file = open(self.path(self.segments[0]), 'rb')
+                while len(lines) < max_lines:
+                    line = self.read_file.readline()
+                    if not line:
+                        break
+                    lines.append(line.rstrip('\n'))
+                if len(lines) >= max_lines:
+                    break
+                if self.write_file is not None and len(self.segments) == 1:
+                    break  # Caught up with the writer, keep the segment.
+                self._delete_oldest()  # We've read all of it.
+            return lines
+        finally:
+            self.lock.release()
+
+    def pending(self):
+        """Returns whether there's anything left to read in the spool."""
+        self.lock.acquire()
+        try:
+            if not self.segments:
+                return False
+            if len(self.segments) > 1 or self.read_file is None:
+                return self.bytes > 0
+            return self.read_file.tell() < os.path.getsize(
+                self.path(self.segments[0]))
+        finally:
+            self.lock.release()
+
+
+class ReaderQueue(object):
+    """The queue between the ReaderThread and the SenderThread.
+
+       Lines are handed over in batches (typically everything we read from a
+       collector in one go), so that moving data between the threads costs
+       one lock acquisition per batch rather than one per line.  The size of
+       the queue is limited in lines, and optionally in bytes of memory,
+       counting QUEUED_LINE_OVERHEAD bytes per line on top of its length.
+
+       There is one queue per priority of the collectors, and the lines of
+       the highest priority are taken out first.  When the queue is full,
+       the drop policy says which lines go: the 'newest' ones that don't
+       fit, the 'oldest' ones already queued, or by 'priority' the oldest
+       queued ones of collectors with a lower priority than the new ones
+       (the newest ones otherwise)."""
+
+    def __init__(self, maxsize, max_bytes=None, drop_policy='priority'):
+        assert drop_policy in DROP_POLICIES, drop_policy
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.drop_policy = drop_policy
+        # Maps a priority to its (time queued, list of lines) tuples.
+        self.levels = {}
+        self.size = 0      # Number of lines in all the batches.
+        self.bytes = 0     # Number of bytes in all the batches.
+        self.not_empty = threading.Condition(threading.Lock())
+        # Where to put the lines that don't fit in the queue, if anywhere.
+        self.spool = None
+        self.lines_spooled = 0
+        self.lines_evicted = 0  # Queued lines dropped for newer ones.
+        # How long batches stay in the queue, in milliseconds.
+        self.queue_time = Histogram([10, 100, 500, 1000, 5000, 10000, 60000])
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def memory(self):
+        """Returns roughly how many bytes of memory the queued lines use."""
+        return self.bytes + self.size * QUEUED_LINE_OVERHEAD
+
+    def fits(self, nlines, nbytes):
+        """Returns whether nlines more lines of nbytes bytes fit."""
+        if self.size + nlines > self.maxsize:
+            return False
+        return (self.max_bytes is None or self.memory() + nbytes
+                + nlines * QUEUED_LINE_OVERHEAD <= self.max_bytes)
+
+    def room(self, lines):
+        """Returns how many of the given lines fit in the queue."""
+        room = max(self.maxsize - self.size, 0)
+        if self.max_bytes is None:
+            return min(room, len(lines))
+        budget = self.max_bytes - self.memory()
+        fit = 0
+        for line in lines[:room]:
+            budget -= len(line) + QUEUED_LINE_OVERHEAD
+            if budget < 0:
+                break
+            fit += 1
+        return fit
+
+    def evict(self, nlines, nbytes, priority):
+        """Takes lines out of the queue according to the drop policy, until
+           nlines lines of nbytes bytes with the given priority fit.
+
+        Returns: The list of lines taken out.
+        """
+        evicted = []
+        while self.levels and not self.fits(nlines, nbytes):
+            if self.drop_policy == 'oldest':
+                level = min(self.levels, key=lambda l: self.levels[l][0][0])
+            else:
+                level = min(self.levels)
+                if level >= priority:
+                    break
+            batches = self.levels[level]
+            queued, batch = batches[0]
+            n = 0
+            while n < len(batch) and not self.fits(nlines, nbytes):
+                self.size -= 1
+                self.bytes -= len(batch[n])
+                n += 1
+            evicted.extend(batch[:n])
+            if n < len(batch):
+                batches[0] = (queued, batch[n:])
+            else:
+                del batches[0]
+                if not batches:
+                    del self.levels[level]
+        return evicted
 
     def nput(self, value):
         """A nonblocking put, that simply logs and discards the value when the
            queue is full, and returns false if we dropped."""
+        return self.nput_batch([value]) == 1
+
+    def nput_batch(self, lines, priority=0):
+        """A nonblocking put of a list of lines.  Whatever doesn't fit in the
+           queue, or has to leave the queue for them as per the drop policy,
+           is spooled to disk if we can, or logged and discarded.
+
+        Args:
+          lines: The lines to queue.
+          priority: The priority of the collector they come from.
+        Returns: The number of lines of the given ones actually queued or
+          spooled.
+        """
+        dropped = ()
+        evicted = ()
+        self.not_empty.acquire()
+        try:
+            nbytes = sum(map(len, lines))
+            if (not self.fits(len(lines), nbytes)
+                and self.drop_policy != 'newest'
+                and len(lines) <= self.maxsize
+                and (self.max_bytes is None or nbytes + len(lines)
+                     * QUEUED_LINE_OVERHEAD <= self.max_bytes)):
+                evicted = self.evict(len(lines), nbytes, priority)
+            room = self.room(lines)
+            if room < len(lines):
+                dropped = lines[room:]
+                lines = lines[:room]
+                nbytes = sum(map(len, lines))
+            if lines:
+                batches = self.levels.get(priority)
+                if batches is None:
+                    batches = self.levels[priority] = []
+                batches.append((time.time(), lines))
+                self.size += len(lines)
+                self.bytes += nbytes
+                self.not_empty.notify()
+        finally:
+            self.not_empty.release()
+        if (dropped or evicted) and self.spool is not None:
+            if self.spool.append(list(evicted) + list(dropped)):
+                self.lines_spooled += len(evicted) + len(dropped)
+                return len(lines) + len(dropped)
+        self.lines_evicted += len(evicted)
+        for line in evicted:
+            LOG.error("DROPPED LINE: %s", line)
+        for line in dropped:
+            LOG.error("DROPPED LINE: %s", line)
+        return len(lines)
+
+    def wait(self, timeout, min_bytes=1):
+        """Waits up to timeout seconds for the queue to hold at least
+           min_bytes bytes.
+
+        Returns: Whether there's anything in the queue.
+        """
+        deadline = time.time() + timeout
+        self.not_empty.acquire()
+        try:
+            while self.bytes < min_bytes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            return self.size > 0
+        finally:
+            self.not_empty.release()
+
+    def oldest(self):
+        """Returns the time at which the oldest batch was queued, or None."""
+        levels = self.levels.values()
+        if levels:
+            return min(batches[0][0] for batches in levels)
+        return None
+
+    def get_batches(self, max_lines, max_bytes=None):
+        """Takes batches out of the queue, without waiting, those of the
+           highest priority first.
+
+        Returns: A list of batches (lists of lines), totalling at most
+          max_lines lines and max_bytes bytes (but at least one line if the
+          queue isn't empty).  The last batch may have been split in two.
+        """
+        now = time.time()
+        self.not_empty.acquire()
+        try:
+            if self.size <= max_lines and (max_bytes is None
+                                           or self.bytes <= max_bytes):
+                levels, self.levels = self.levels, {}
+                self.size = self.bytes = 0
+                batches = []
+                for level in sorted(levels, reverse=True):
+                    for queued, batch in levels[level]:
+                        self.queue_time.add(int((now - queued) * 1000))
+                        batches.append(batch)
+                return batches
+            batches = []
+            lines = nbytes = 0
+            for level in sorted(self.levels, reverse=True):
+                queue = self.levels[level]
+                while queue and lines < max_lines:
+                    queued, batch = queue[0]
+                    room = max_lines - lines
+                    if max_bytes is not None:
+                        # Count how many lines fit in the bytes we have left.
+                        fit = 0
+                        for line in batch[:room]:
+                            if (nbytes + len(line) > max_bytes
+                                and (lines or fit)):
+                                break
+                            nbytes += len(line)
+                            fit += 1
+                        room = fit
+                        if not room:
+                            break
+                    else:
+                        nbytes += sum(map(len, batch[:room]))
+                    if room < len(batch):
+                        queue[0] = (queued, batch[room:])
+                        batch = batch[:room]
+                    else:
+                        # count the batch once, when its last lines leave.
+                        del queue[0]
+                        self.queue_time.add(int((now - queued) * 1000))
+                    batches.append(batch)
+                    lines += len(batch)
+                if not queue:
+                    del self.levels[level]
+                else:
+                    break  # We're full.
+            self.size -= lines
+            self.bytes -= nbytes
+            return batches
+        finally:
+            self.not_empty.release()
+
+
+class ReaderPoller(object):
+    """Waits for output on the pipes of our collectors using epoll(7).
+
+       The stdout and stderr pipes of each collector are registered when the
+       collector is spawned and unregistered when it is reaped, so that the
+       ReaderThread only wakes up when there actually is something to read.
+       A self-pipe allows other threads to interrupt a pending poll()."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.lock = threading.Lock()
+        self.fds = {}  # Maps a registered fd to its Collector.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        set_nonblocking(self.wakeup_r)
+        set_nonblocking(self.wakeup_w)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+
+    def register(self, col):
+        """Starts watching the stdout and stderr of the given collector."""
+        self.lock.acquire()
+        try:
+            for f in (col.proc.stdout, col.proc.stderr):
+                fd = f.fileno()
+                try:
+                    self.epoll.register(fd, select.EPOLLIN)
+                except IOError, (err, msg):
+                    # A closed fd that got reused before we noticed it.
+                    if err != errno.EEXIST:
+                        raise
+                    self.epoll.modify(fd, select.EPOLLIN)
+                self.fds[fd] = col
+        finally:
+            self.lock.release()
+
+    def unregister(self, col):
+        """Stops watching the pipes of the given collector, if we were."""
+        self.lock.acquire()
+        try:
+            for fd, other in self.fds.items():
+                if other is col:
+                    self._unregister_fd(fd)
+        finally:
+            self.lock.release()
+
+    def watching(self, col):
+        """Returns whether some pipe of the given collector is still
+           registered, that is, it may still have something to read."""
+        self.lock.acquire()
+        try:
+            return col in self.fds.itervalues()
+        finally:
+            self.lock.release()
+
+    def _unregister_fd(self, fd):
+        del self.fds[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass  # The fd was already closed, the kernel forgot about it.
+
+    def wakeup(self):
+        """Interrupts the current (or next) call to poll()."""
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, (err, msg):
+            if err != errno.EAGAIN:  # Already a pending wakeup.
+                raise
+
+    def poll(self, timeout):
+        """Generator that waits up to `timeout' seconds (forever if negative)
+           for output, and yields every collector that has something to read.
+           Pipes whose writer went away are forgotten once the caller is done
+           reading from them."""
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, (err, msg):
+            if err != errno.EINTR:
+                raise
+            return
+        ready = []
+        hungup = []
+        self.lock.acquire()
+        try:
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    try:
+                        while os.read(self.wakeup_r, 4096):
+                            pass
+                    except OSError, (err, msg):
+                        if err != errno.EAGAIN:
+                            raise
+                    continue
+                col = self.fds.get(fd)
+                if col is None:
+                    continue
+                if col not in ready:
+                    ready.append(col)
+                # Once the writer is gone, the fd will stay readable forever,
+                # so stop watching it after the last read.
+                if event & (select.EPOLLHUP | select.EPOLLERR):
+                    hungup.append(fd)
+        finally:
+            self.lock.release()
+        for col in ready:
+            yield col
+        if hungup:
+            self.lock.acquire()
+            try:
+                for fd in hungup:
+                    if fd in self.fds:
+                        self._unregister_fd(fd)
+            finally:
+                self.lock.release()
+            # the main loop may be waiting for this to reap the collector.
+            wakeup_main_loop()
+
+
+class DirectoryWatcher(object):
+    """Watches the collector directories and the 'etc' directory with
+       inotify, so we don't have to list them and stat every file they
+       contain every SCAN_INTERVAL to find out what changed."""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+    IN_NONBLOCK = os.O_NONBLOCK
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+            | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len of the name.
+
+    def __init__(self, cdir):
+        """Constructor.  Raises OSError if we can't use inotify.
+
+        Args:
+          cdir: The path to the 'collectors' directory.
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.cdir = cdir
+        self.etcdir = os.path.join(cdir, 'etc')
+        self.watches = {}  # Maps a watch descriptor to its directory.
+        self.watch(cdir)
+        if os.path.isdir(self.etcdir):
+            self.watch(self.etcdir)
+        for name in os.listdir(cdir):
+            if name.isdigit():
+                self.watch(os.path.join(cdir, name))
+
+    @classmethod
+    def create(cls, cdir):
+        """Returns a DirectoryWatcher, or None if inotify isn't available."""
+        try:
+            return cls(cdir)
+        except (AttributeError, OSError), e:  # No inotify in the libc.
+            LOG.info('Not using inotify, polling the collector directories'
+                     ' instead: %s', e)
+            return None
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            LOG.warning('failed to watch %s: %s', path,
+                        os.strerror(ctypes.get_errno()))
+            return
+        self.watches[wd] = path
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Reads the pending events, without blocking.
+
+        Returns:
+          A pair of booleans: whether anything changed in the collector
+          directories, and whether anything changed in the 'etc' directory.
+        """
+        collectors = etc = False
+        data = ''
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+            if not buf:
+                break
+            data += buf
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                return True, True
+            path = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            if path == self.etcdir:
+                etc = True
+                continue
+            collectors = True
+            if (path == self.cdir and mask & self.IN_ISDIR
+                and mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+                if name.isdigit():
+                    self.watch(os.path.join(path, name))
+                elif name == 'etc':
+                    self.watch(self.etcdir)
+                    etc = True
+        return collectors, etc
+
+
+class LineBuffer(object):
+    """Accumulates the output of a collector and frames it into lines.
+
+       The data is read straight into a preallocated bytearray, and a read
+       offset tracks what has been consumed already, so extracting all the
+       complete lines of a chunk is done in a single pass instead of slicing
+       the remainder of the buffer once per line."""
+
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # Offset of the first byte not consumed yet.
+        self.end = 0    # Offset right after the last byte read.
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self):
+        """Moves the partial line at the end of the buffer to the front, and
+           grows the buffer if the partial line fills it up entirely."""
+        size = self.end - self.start
+        if size * 2 > len(self.buf):
+            buf = bytearray(len(self.buf) * 2)
+            buf[0:size] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+        elif size:
+            self.buf[0:size] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def fill(self, f):
+        """Reads everything available from the given non-blocking raw file.
+
+        Returns: The number of bytes read, which is 0 at EOF or if reading
+          would block.
+        """
+        total = 0
+        while True:
+            if self.end == len(self.buf):
+                self._make_room()
+            n = f.readinto(self.view[self.end:])
+            if not n:  # None when we would block, 0 at EOF.
+                return total
+            self.end += n
+            total += n
+
+    def lines(self):
+        """Returns the list of complete lines in the buffer and consumes
+           them.  Any partial line is kept until the rest of it arrives."""
+        last = self.buf.rfind('\n', self.start, self.end)
+        if last == -1:
+            return []
+        lines = self.view[self.start:last].tobytes().split('\n')
+        if last + 1 == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = last + 1
+        return lines
+
+
+class DedupEntry(object):
+    """The last value seen for a given (metric, tags) in a DedupStore."""
+
+    __slots__ = ('value', 'repeated', 'last_timestamp', 'timestamp')
+
+    def __init__(self, value, timestamp):
+        self.value = value  # Last value seen.
+        self.repeated = False  # Whether the value was seen more than once.
+        # When we saw the value for the last time.  We keep this rather than
+        # the whole line, which we can rebuild when we need to send it.
+        self.last_timestamp = timestamp
+        self.timestamp = timestamp  # When we saw the value for the first time.
+
+    def line(self, metric, tags):
+        """Returns the last line of data we got for this value."""
+        return '%s %d %s%s' % (metric, self.last_timestamp, self.value, tags)
+
+
+class DedupStore(object):
+    """Keeps track of the last value of each (metric, tags) of a collector,
+       to remove duplicate values.
+
+       Entries are also filed in a time wheel: buckets of WHEEL_SPAN seconds
+       indexed by the time at which their value was first seen.  Evicting
+       old entries only has to look at the buckets that expired instead of
+       going through all the series we've ever seen."""
+
+    WHEEL_SPAN = 60  # seconds
+
+    def __init__(self):
+        self.entries = {}  # Maps (metric, tags) to a DedupEntry.
+        self.wheel = {}    # Maps a bucket number to a set of keys.
+        self.buckets = []  # Heap of the bucket numbers in the wheel.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Returns the DedupEntry for the given key, or None."""
+        return self.entries.get(key)
+
+    def _file(self, key, timestamp):
+        bucket = timestamp // self.WHEEL_SPAN
+        keys = self.wheel.get(bucket)
+        if keys is None:
+            keys = self.wheel[bucket] = set()
+            heapq.heappush(self.buckets, bucket)
+        keys.add(key)
+
+    def set(self, key, value, timestamp):
+        """Records a new value for the given key, first seen at timestamp."""
+        entry = self.entries.get(key)
+        if entry is None:
+            # the tags are interned by the LineParser already.
+            key = (INTERN(key[0]), key[1])
+            self.entries[key] = DedupEntry(value, timestamp)
+            self._file(key, timestamp)
+            return
+        old_bucket = entry.timestamp // self.WHEEL_SPAN
+        if old_bucket != timestamp // self.WHEEL_SPAN:
+            self.wheel[old_bucket].discard(key)
+            self._file(key, timestamp)
+        entry.value = value
+        entry.repeated = False
+        entry.last_timestamp = timestamp
+        entry.timestamp = timestamp
+
+    def evict(self, cut_off):
+        """Removes the entries whose value was first seen before cut_off."""
+        last_bucket = cut_off // self.WHEEL_SPAN
+        while self.buckets and self.buckets[0] < last_bucket:
+            for key in self.wheel.pop(heapq.heappop(self.buckets)):
+                del self.entries[key]
+        # The bucket cut_off falls in is only partly expired.
+        keys = self.wheel.get(last_bucket, ())
+        expired = [key for key in keys
+                   if self.entries[key].timestamp < cut_off]
+        for key in expired:
+            keys.discard(key)
+            del self.entries[key]
+
+    def memory_usage(self):
+        """Returns an estimate of the number of bytes used by the store, not
+           counting the metric names and tags, which are in the INTERN table."""
+        size = sys.getsizeof(self.entries) + sys.getsizeof(self.wheel)
+        size += sys.getsizeof(self.buckets)
+        for keys in self.wheel.values():
+            size += sys.getsizeof(keys)
+        size += len(self.entries) * (sys.getsizeof(DedupEntry(None, 0))
+                                     + sys.getsizeof(('', '')))
+        return size
+
+
+class ProcessStats(object):
+    """Reads the resource usage of a process from /proc.  The files are
+       opened once and read again from the start each time, which is cheap,
+       and keeps on referring to the same process even if its PID gets
+       reused."""
+
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+    def __init__(self, pid):
+        self.fds = {}
+        for name in ('stat', 'statm', 'io'):
+            try:
+                self.fds[name] = os.open('/proc/%d/%s' % (pid, name),
+                                         os.O_RDONLY)
+            except OSError:
+                pass  # /proc/<pid>/io needs privileges, or no /proc at all.
+
+    def read_file(self, name):
+        fd = self.fds.get(name)
+        if fd is None:
+            return None
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096)
+
+    def read(self):
+        """Returns the (cpu_seconds, rss_bytes, read_bytes) the process used,
+           or None if it's gone."""
         try:
-            self.put(value, False)
-        except Full:
-            LOG.error("DROPPED LINE: %s", value)
+            stat = self.read_file('stat')
+            statm = self.read_file('statm')
+            io = self.read_file('io')
+        except OSError:
+            return None  # The process was reaped.
+        if not stat:
+            return None
+        # utime, stime, cutime and cstime come after the command name,
+        # which can contain spaces.
+        fields = stat[stat.rindex(')') + 2:].split()
+        cpu = sum(int(ticks) for ticks in fields[11:15]) / float(self.CLOCK_TICKS)
+        rss = 0
+        if statm:
+            rss = int(statm.split()[1]) * self.PAGE_SIZE
+        read_bytes = 0
+        for line in (io or '').splitlines():
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line.split()[1])
+        return cpu, rss, read_bytes
+
+    def close(self):
+        for fd in self.fds.itervalues():
+            os.close(fd)
+        self.fds = {}
+
+
+class ResourceUsage(object):
+    """The resources used by all the processes a collector ran so far.
+       It's carried over when the Collector gets registered again."""
+
+    def __init__(self):
+        self.spawn_count = 0
+        self.runtime = 0.0       # Of the processes that exited, in seconds.
+        self.cpu_seconds = 0.0   # Of the processes that exited.
+        self.read_bytes = 0      # Of the processes that exited.
+        self.stats = None  # ProcessStats of the running process.
+        self.started = None  # When the running process was started.
+        self.last = (0, 0, 0)  # Last reading of the running process.
+
+    def start(self, proc):
+        """Starts accounting for a new process of the collector."""
+        self.finish()
+        self.spawn_count += 1
+        self.started = time.time()
+        # in-process collectors share our PID, we can't tell them apart.
+        if not isinstance(proc, ThreadProc):
+            self.stats = ProcessStats(proc.pid)
+
+    def sample(self):
+        """Reads the usage of the running process, until it gets reaped."""
+        if self.stats is not None:
+            usage = self.stats.read()
+            if usage is not None:
+                self.last = usage
+
+    def finish(self, usage=None):
+        """Adds the usage of the process that exited to the totals.
+
+        Args:
+          usage: The (cpu_seconds, rss_bytes, read_bytes) of the process
+            when it was reaped, for the ones we can't sample before that
+            (the ForkServer reaps its collectors).
+        """
+        if self.started is None:
+            return
+        if usage is not None:
+            self.last = usage
+        self.runtime += time.time() - self.started
+        self.cpu_seconds += self.last[0]
+        self.read_bytes += self.last[2]
+        self.started = None
+        self.last = (0, 0, 0)
+        if self.stats is not None:
+            self.stats.close()
+            self.stats = None
+
+    def totals(self):
+        """Returns the (cpu_seconds, rss_bytes, read_bytes, runtime) of all
+           the processes so far, the running one included."""
+        runtime = self.runtime
+        if self.started is not None:
+            runtime += time.time() - self.started
+        cpu, rss, read_bytes = self.last
+        return (self.cpu_seconds + cpu, rss, self.read_bytes + read_bytes,
+                runtime)
+
+
+class CgroupManager(object):
+    """Puts each collector in its own cgroup (v2), under a cgroup delegated
+       to tcollector, to limit the CPU and memory it can use.
+
+       tcollector itself must not be in that cgroup: with cgroup v2, only
+       the leaves of the tree can have processes once controllers are
+       enabled."""
+
+    CPU_PERIOD = 100000  # microseconds
+
+    def __init__(self, root, cpu=None, memory_max=None):
+        """Constructor.  Raises IOError or OSError if the cgroup can't be
+           set up.
+
+        Args:
+          root: The path to the cgroup to create the collectors' cgroups in,
+            like /sys/fs/cgroup/tcollector.
+          cpu: How many CPUs each collector can use (e.g. 0.5), or None.
+          memory_max: How many bytes of memory each collector can use, or
+            None.
+        """
+        self.root = root
+        self.cpu_max = None
+        if cpu is not None:
+            self.cpu_max = '%d %d' % (cpu * self.CPU_PERIOD, self.CPU_PERIOD)
+        self.memory_max = memory_max
+        controllers = open(os.path.join(root, 'cgroup.controllers')).read()
+        enable = [name for name in ('cpu', 'memory')
+                  if name in controllers.split()]
+        self.write(os.path.join(root, 'cgroup.subtree_control'),
+                   ' '.join('+' + name for name in enable))
+
+    @staticmethod
+    def write(path, value):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            os.write(fd, value)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def read(path):
+        """Returns the 'key value' lines of a cgroup file as a dict."""
+        try:
+            lines = open(path).read().splitlines()
+        except IOError:
+            return {}
+        return dict(line.split(None, 1) for line in lines if ' ' in line)
+
+    def path(self, col):
+        return os.path.join(self.root, re.sub(r'[^-_.a-zA-Z0-9]', '_', col.name))
+
+    def setup(self, col):
+        """Creates the cgroup of a collector and applies the limits to it.
+
+        Returns:
+          The path to the cgroup, or None if it couldn't be set up.
+        """
+        path = self.path(col)
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            if self.cpu_max is not None:
+                self.write(os.path.join(path, 'cpu.max'), self.cpu_max)
+            if self.memory_max is not None:
+                self.write(os.path.join(path, 'memory.max'),
+                           str(self.memory_max))
+        except (IOError, OSError), e:
+            LOG.error('failed to set up the cgroup of %s: %s', col.name, e)
+            return None
+        return path
+
+    @staticmethod
+    def join(path):
+        """Moves the calling process to the cgroup with the given path."""
+        CgroupManager.write(os.path.join(path, 'cgroup.procs'), '0')
+
+    def stats(self, col):
+        """Returns the (name, value) pairs of the throttling stats of the
+           cgroup of a collector."""
+        path = self.path(col)
+        cpu = self.read(os.path.join(path, 'cpu.stat'))
+        memory = self.read(os.path.join(path, 'memory.events'))
+        try:
+            current = int(open(os.path.join(path, 'memory.current')).read())
+        except (IOError, ValueError):
+            current = 0
+        return [('cgroup.nr_throttled', int(cpu.get('nr_throttled', 0))),
+                ('cgroup.throttled_usec', int(cpu.get('throttled_usec', 0))),
+                ('cgroup.memory_current', current),
+                ('cgroup.memory_max_events', int(memory.get('max', 0))),
+                ('cgroup.oom_kills', int(memory.get('oom_kill', 0)))]
+
+
+class TokenBucket(object):
+    """Allows rate events per second on average, and bursts of up to burst
+       events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def consume(self, now=None):
+        """Returns whether an event is allowed now, and counts it if so."""
+        if now is None:
+            now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
             return False
+        self.tokens -= 1
         return True
 
 
+class AsyncLogHandler(logging.Handler):
+    """Hands the log records over to another handler that runs in a thread
+       of its own, so that logging never blocks on the disk.  When more than
+       maxsize records are waiting to be written, the new ones are dropped
+       and we log how many later on."""
+
+    def __init__(self, handler, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.maxsize = maxsize
+        self.records = []
+        self.writing = 0  # Records taken off the queue but not written yet.
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='logging')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            # the arguments can change by the time the record gets written,
+            # so format the message now.
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+        except:
+            self.handleError(record)
+            return
+        with self.cond:
+            if len(self.records) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.records.append(record)
+            self.cond.notifyAll()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.records and not self.dropped:
+                    self.cond.wait()
+                records, self.records = self.records, []
+                dropped, self.dropped = self.dropped, 0
+                self.writing = len(records)
+            for record in records:
+                self.handler.handle(record)
+            if dropped:
+                self.handler.handle(logging.makeLogRecord({
+                    'name': LOG.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log messages dropped' % dropped}))
+            with self.cond:
+                self.writing = 0
+                self.cond.notifyAll()
+
+    def flush(self, timeout=5):
+        """Waits up to timeout seconds for the records to be written."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.records or self.writing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+        self.handler.flush()
+
+    def close(self):
+        self.flush()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
 class Collector(object):
     """A Collector is a script that is run that gathers some data
        and prints it out in standard TSD format on STDOUT.  This
@@ -102,24 +1330,30 @@ class Collector(object):
         self.interval = interval
         self.filename = filename
         self.lastspawn = lastspawn
+        self.next_run = None  # When an interval collector runs next.
+        self.schedule_lag = 0  # How late it started last time, in seconds.
+        self.usage = ResourceUsage()
+        self.stderr_bucket = TokenBucket(STDERR_RATE, STDERR_BURST)
+        self.stderr_suppressed = 0  # Lines of stderr we didn't log yet.
+        # Lines of collectors with a higher priority are sent first, and
+        # dropped last when the reader queue is full (see --priority).
+        self.priority = PRIORITIES.get(colname, 0)
         self.proc = None
+        self.exit_time = None  # When self.proc exited, until it's reaped.
         self.nextkill = 0
         self.killstate = 0
         self.dead = False
         self.mtime = mtime
         self.generation = GENERATION
-        self.buffer = ""
+        self.buffer = LineBuffer()
+        self.stdout = None  # Raw file we read the output of self.proc from.
         self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
+        # Maps (metric, tags) to the last value seen for it.
+        # This is used to keep track of and remove duplicate values.
         # Since it might grow unbounded (in case we see many different
         # combinations of metrics and tags) someone needs to regularly call
         # evict_old_keys() to remove old entries.
-        self.values = {}
+        self.values = DedupStore()
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
@@ -141,7 +1375,7 @@ class Collector(object):
                 LOG.debug('reading %s got %d bytes on stderr',
                           self.name, len(out))
                 for line in out.splitlines():
-                    LOG.warning('%s: %s', self.name, line)
+                    self.log_stderr(line)
         except IOError, (err, msg):
             if err != errno.EAGAIN:
                 raise
@@ -152,8 +1386,10 @@ class Collector(object):
         # out a bunch of data points at one time and we get some weird sized
         # chunk.  This read call is non-blocking.
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
+            fd = self.proc.stdout.fileno()
+            if self.stdout is None or self.stdout.fileno() != fd:
+                self.stdout = io.FileIO(fd, 'r', closefd=False)
+            if self.buffer.fill(self.stdout):
                 LOG.debug('reading %s, buffer now %d bytes',
                           self.name, len(self.buffer))
         except IOError, (err, msg):
@@ -165,18 +1401,31 @@ class Collector(object):
             LOG.exception('uncaught exception in stdout read')
             return
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
-
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
+        # pull all the full lines out of the buffer at once
+        received = False
+        for line in self.buffer.lines():
+            line = line.strip()
             if line:
                 self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx+1:]
+                received = True
+        if received:
+            self.last_datapoint = int(time.time())
+
+    def log_stderr(self, line):
+        """Logs a line the collector wrote on stderr, unless it's writing
+           more than STDERR_RATE lines per second."""
+        if self.stderr_bucket.consume():
+            self.log_suppressed()
+            LOG.warning('%s: %s', self.name, line)
+        else:
+            self.stderr_suppressed += 1
+
+    def log_suppressed(self):
+        """Logs how many lines of stderr we didn't log since last time."""
+        if self.stderr_suppressed:
+            LOG.warning('%s: %d messages suppressed',
+                        self.name, self.stderr_suppressed)
+            self.stderr_suppressed = 0
 
     def collect(self):
         """Reads input from the collector and returns the lines up to whomever
@@ -187,8 +1436,9 @@ class Collector(object):
             self.read()
             if not len(self.datalines):
                 return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            lines, self.datalines = self.datalines, []
+            for line in lines:
+                yield line
 
     def shutdown(self):
         """Cleanly shut down the collector"""
@@ -217,10 +1467,7 @@ class Collector(object):
           cut_off: A UNIX timestamp.  Any value that's older than this will be
             removed from the cache.
         """
-        for key in self.values.keys():
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+        self.values.evict(cut_off)
 
 
 class StdinCollector(Collector):
@@ -249,19 +1496,551 @@ class StdinCollector(Collector):
         else:
             ALIVE = False
 
+    def collect(self):
+        """Returns the next line read from STDIN (if any).  Unlike other
+           collectors we don't keep reading until we run out of input, as
+           that would only happen at EOF and the ReaderThread would hold on
+           to all the lines until then."""
+
+        self.read()
+        lines, self.datalines = self.datalines, []
+        return lines
 
     def shutdown(self):
 
         pass
 
 
+class ThreadProc(object):
+    """Runs a Python collector in a thread of tcollector instead of its own
+       interpreter.  The collector has to define a collect() function that
+       is a generator of lines of data, which we call instead of running
+       the script.  Its module is loaded without running its main(), so it
+       doesn't drop the privileges of tcollector or print anything.
+
+       This looks enough like a subprocess.Popen for the rest of tcollector
+       not to care: the lines go through a real pipe, exceptions end up as
+       a traceback on stderr and a status code of 1, and signals ask the
+       collector to stop after its next line.  We can't stop a thread that
+       doesn't yield anything though, so after a SIGKILL we close our ends
+       of its pipes, for it to fail on its next write, and don't start the
+       collector again until the thread is gone.
+
+       Since they share our process, the in-process collectors aren't put
+       in cgroups (see --cgroup) and their CPU, memory and I/O aren't
+       accounted for in the collector.* metrics of ResourceUsage."""
+
+    # The compiled code of the collectors, by filename, with its mtime.
+    code_cache = {}
+    # The last thread started for each collector, by name.
+    threads = {}
+    # The collectors we said we couldn't start because of such a thread.
+    stuck = set()
+
+    def __init__(self, col):
+        self.col = col
+        self.pid = os.getpid()
+        self.returncode = None
+        self.stopping = False
+        rout, self.wout = os.pipe()
+        rerr, self.werr = os.pipe()
+        self.stdout = os.fdopen(rout, 'rb', 0)
+        self.stderr = os.fdopen(rerr, 'rb', 0)
+        self.thread = threading.Thread(target=self.run,
+                                       name='collector ' + col.name)
+        self.thread.setDaemon(True)
+        self.threads[col.name] = self.thread
+        self.stuck.discard(col.name)
+        self.thread.start()
+
+    @classmethod
+    def still_running(cls, col):
+        """Returns whether the thread of a previous run of the collector,
+           one we gave up on, is still around."""
+        thread = cls.threads.get(col.name)
+        return thread is not None and thread.isAlive()
+
+    @staticmethod
+    def supports(filename):
+        """Returns whether the given collector can run in-process."""
+        if not filename.endswith('.py'):
+            return False
+        try:
+            source = open(filename).read()
+        except IOError:
+            return False
+        return re.search(r'^def collect\(\)', source, re.MULTILINE) is not None
+
+    def load(self):
+        """Returns a fresh module with the code of our collector."""
+        filename = self.col.filename
+        mtime, code = self.code_cache.get(filename, (None, None))
+        if mtime != self.col.mtime:
+            code = compile(open(filename).read(), filename, 'exec')
+            self.code_cache[filename] = (self.col.mtime, code)
+        module = {'__name__': 'tcollector_' + re.sub(r'\W', '_', self.col.name),
+                  '__file__': filename}
+        exec code in module
+        return module
+
+    def run(self):
+        status = 0
+        try:
+            lines = self.load()['collect']()
+            try:
+                for line in lines:
+                    if self.stopping:
+                        status = -signal.SIGTERM
+                        break
+                    self.write(self.wout, '%s\n' % line)
+            finally:
+                lines.close()
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                status = 1
+        except:
+            status = 1
+            try:
+                self.write(self.werr, traceback.format_exc())
+            except OSError:
+                pass
+        finally:
+            os.close(self.wout)
+            os.close(self.werr)
+            if self.returncode is None:
+                self.returncode = status
+            wakeup_main_loop()
+
+    @staticmethod
+    def write(fd, data):
+        while data:
+            data = data[os.write(fd, data):]
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self.thread.join(1)
+        return self.returncode
+
+    def send_signal(self, signum):
+        self.stopping = True
+        if signum == signal.SIGKILL and self.returncode is None:
+            LOG.warning('giving up on the thread of %s', self.col.name)
+            # it gets EPIPE when it writes again, if it's not stuck writing
+            # already.
+            if POLLER is not None:
+                POLLER.unregister(self.col)
+            self.stdout.close()
+            self.stderr.close()
+            self.returncode = -signum
+
+
+class ForkServer(object):
+    """A process forked from tcollector before it starts any thread, that
+       has imported the modules the Python collectors commonly use, and
+       forks itself to run the interval collectors.  That saves them the
+       startup of an interpreter and those imports every time they run.
+
+       We talk to it over a socketpair, one JSON message per line.  Python
+       2 can't pass file descriptors over a socket, so the output of the
+       collectors goes through FIFOs that we create and open for reading
+       before asking the ForkServer to start a collector.  The ForkServer
+       reaps the collectors and tells us their status code, and the
+       resources they used since we can't read them from /proc anymore."""
+
+    # What the Python collectors commonly import.
+    PRELOAD = ('collectors.lib.utils', 'httplib', 'json', 'socket',
+               'subprocess', 'urllib2')
+
+    def __init__(self):
+        self.sock = None
+        self.pid = None
+        self.fifodir = None
+        self.buffer = ''
+        self.exited = {}  # Maps a PID to its 'exited' message.
+        self.procs = {}  # Maps a PID to its ForkProc, until it's reaped.
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.fifodir = tempfile.mkdtemp(prefix='tcollector-')
+        self.sock, child = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid:
+            child.close()
+            LOG.info('started the forkserver (pid=%d)', self.pid)
+            return
+        status = 1
+        try:
+            self.log_to_stderr()
+            self.sock.close()
+            self.sock = child
+            self.serve()
+            status = 0
+        except:
+            LOG.exception('forkserver died')
+        os._exit(status)
+
+    @staticmethod
+    def log_to_stderr():
+        """Makes the ForkServer process log to stderr: the log file belongs
+           to tcollector, two processes rotating it would lose logs."""
+        formatter = None
+        for handler in LOG.handlers[:]:
+            formatter = handler.formatter
+            LOG.removeHandler(handler)
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(formatter)
+        LOG.addHandler(handler)
+
+    def serve(self):
+        """Main loop of the ForkServer process."""
+        # ^C is for tcollector, who'll close our socket when exiting.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sys.path[:0] = [path for path
+                        in os.environ.get('PYTHONPATH', '').split(':') if path]
+        for name in self.PRELOAD:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+        # Wake up as soon as a collector exits.
+        wakeup, wakeup_w = os.pipe()
+        set_nonblocking(wakeup)
+        set_nonblocking(wakeup_w)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        children = set()
+        while True:
+            try:
+                ready = select.select([self.sock, wakeup], [], [], 5)[0]
+            except select.error, (err, msg):
+                if err != errno.EINTR:
+                    raise
+                ready = []
+            if wakeup in ready:
+                try:
+                    os.read(wakeup, 4096)
+                except OSError:
+                    pass
+            if self.sock in ready:
+                request = self.recv()
+                if request is None:
+                    return  # tcollector is gone.
+                self.send(self.fork(request, children))
+            while children:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+                if not pid:
+                    break
+                children.discard(pid)
+                if os.WIFSIGNALED(status):
+                    status = -os.WTERMSIG(status)
+                else:
+                    status = os.WEXITSTATUS(status)
+                # ru_maxrss is in kB, ru_inblock in 512-byte blocks.
+                self.send({'exited': pid, 'status': status,
+                           'usage': (rusage.ru_utime + rusage.ru_stime,
+                                     rusage.ru_maxrss * 1024,
+                                     rusage.ru_inblock * 512)})
+
+    def fork(self, request, children):
+        """Starts a collector as asked by tcollector."""
+        try:
+            stdout = os.open(request['stdout'], os.O_WRONLY)
+            stderr = os.open(request['stderr'], os.O_WRONLY)
+        except OSError, e:
+            return {'error': str(e)}
+        try:
+            pid = os.fork()
+        except OSError, e:
+            os.close(stdout)
+            os.close(stderr)
+            return {'error': str(e)}
+        if not pid:
+            self.run_collector(request['filename'], stdout, stderr,
+                               request.get('cgroup'))
+        # tcollector kills the process group of the collectors, so don't
+        # tell it about this one before it has its own.
+        try:
+            while os.getpgid(pid) != pid:
+                time.sleep(0.001)
+        except OSError:
+            pass
+        os.close(stdout)
+        os.close(stderr)
+        children.add(pid)
+        return {'pid': pid}
+
+    def run_collector(self, filename, stdout, stderr, cgroup=None):
+        """Runs a collector in a child of the ForkServer.  Never returns."""
+        status = 1
+        try:
+            if cgroup is not None:
+                CgroupManager.join(cgroup)
+            os.setsid()
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            os.dup2(stdout, 1)
+            os.dup2(stderr, 2)
+            os.closerange(3, subprocess.MAXFD)
+            sys.argv = [filename]
+            runpy.run_path(filename, run_name='__main__')
+            status = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except:
+            traceback.print_exc()
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+    def stop(self):
+        """Makes the ForkServer exit, by closing our side of the socket."""
+        self.sock.close()
+        try:
+            os.rmdir(self.fifodir)
+        except OSError:
+            pass
+
+    def abandon(self):
+        """Forgets about the ForkServer after it died.  Nobody can reap the
+           collectors it started anymore, so they're killed and marked as
+           exited with a status code of 0, to get started again."""
+        for proc in self.procs.itervalues():
+            try:
+                kill(proc)
+            except OSError:
+                pass  # It exited already.
+            if proc.returncode is None:
+                proc.returncode = 0
+        self.procs.clear()
+        self.stop()
+        try:
+            os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            pass
+
+    def recv(self):
+        """Returns the next message, or None if the other side is gone."""
+        while '\n' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return json.loads(line)
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message) + '\n')
+
+    def spawn(self, col, cgroup=None):
+        """Starts the given collector, and returns a ForkProc for it.
+           If cgroup isn't None, the collector runs in that cgroup."""
+        with self.lock:
+            proc = ForkProc(self, col, cgroup)
+            self.procs[proc.pid] = proc
+            return proc
+
+    def poll(self, pid):
+        """Returns the 'exited' message of the given collector, with its
+           status code and usage, or None if it's still running."""
+        with self.lock:
+            self.drain()
+            exited = self.exited.pop(pid, None)
+            if exited is not None:
+                self.procs.pop(pid, None)
+            return exited
+
+    def drain(self):
+        """Reads the messages the ForkServer sent us, without blocking."""
+        while select.select([self.sock], [], [], 0)[0]:
+            self.handle(self.recv())
+
+    def handle(self, message):
+        """Handles a message from the ForkServer, and returns it."""
+        if message is None:
+            raise socket.error(errno.EPIPE, 'the forkserver died')
+        if 'exited' in message:
+            self.exited[message['exited']] = message
+        return message
+
+
+class ForkProc(object):
+    """A collector started by the ForkServer, that looks like a Popen."""
+
+    def __init__(self, server, col, cgroup=None):
+        self.server = server
+        self.returncode = None
+        self.usage = None  # (cpu_seconds, rss_bytes, read_bytes) once reaped.
+        paths = [os.path.join(server.fifodir, '%s.%s' % (col.name, stream))
+                 for stream in ('stdout', 'stderr')]
+        fds = []
+        try:
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+                os.mkfifo(path, 0600)
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            server.send({'filename': col.filename, 'cgroup': cgroup,
+                         'stdout': paths[0], 'stderr': paths[1]})
+            reply = server.handle(server.recv())
+            while 'exited' in reply:
+                reply = server.handle(server.recv())
+        except:
+            for fd in fds:
+                os.close(fd)
+            raise
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+        if 'error' in reply:
+            for fd in fds:
+                os.close(fd)
+            raise OSError(errno.EIO, reply['error'])
+        self.pid = reply['pid']
+        self.stdout = os.fdopen(fds[0], 'rb', 0)
+        self.stderr = os.fdopen(fds[1], 'rb', 0)
+
+    def poll(self):
+        if self.returncode is None:
+            exited = self.server.poll(self.pid)
+            if exited is not None:
+                self.usage = tuple(exited['usage'])
+                self.returncode = exited['status']
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            select.select([self.server.sock], [], [], 1)
+        return self.returncode
+
+
+class LineParser(object):
+    """Parses and validates the lines of data sent by the collectors.
+
+       In 'lenient' mode the value can be any token, like it always could.
+       In 'strict' mode the value must be a number and tag names must not
+       be repeated.  The regexp is compiled once (on CPython it beats
+       splitting the line and checking each field by hand) and the tags are
+       only parsed and sorted the first time we see them.  The tags returned
+       are shared through the INTERN table."""
+
+    MODES = ('lenient', 'strict')
+    LINE_RE = re.compile(r'^([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                         r'(\d+)\s+'               # Timestamp.
+                         r'(\S+?)'                 # Value (int or float).
+                         r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$')  # Tags
+    NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+    MAX_TAGS_CACHE_SIZE = 10000
+
+    def __init__(self, mode='lenient'):
+        assert mode in self.MODES, 'invalid validation mode %r' % (mode,)
+        self.strict = mode == 'strict'
+        self.match = self.LINE_RE.match
+        self.tags_cache = {}  # Maps tags as sent to their canonical form.
+
+    def parse(self, line):
+        """Parses a line of data.
+
+        Returns: A tuple (metric, timestamp, value, tags) where the timestamp
+          is an int and tags is a string of ' name=value' pairs sorted by
+          name (or the empty string), or None if the line is invalid.
+        """
+        parsed = self.match(line)
+        if parsed is None:
+            return None
+        metric, timestamp, value, tags = parsed.groups()
+        if self.strict and not self.NUMBER_RE.match(value):
+            return None
+        if tags:
+            # Collectors send the same few tag strings over and over again.
+            try:
+                tags = self.tags_cache[tags]
+            except KeyError:
+                tags = self.canonicalize_tags(tags)
+            if tags is None:
+                return None
+        return metric, int(timestamp), value, tags
+
+    def canonicalize_tags(self, raw):
+        """Returns the sorted version of the given tags, or None if they're
+           invalid, and remembers the result for the next time."""
+        tags = raw.split()
+        tags.sort()
+        if self.strict:
+            # Once sorted, tags with the same name are adjacent.
+            prev = None
+            for tag in tags:
+                name = tag[:tag.index('=')]
+                if name == prev:
+                    tags = None
+                    break
+                prev = name
+        if tags is not None:
+            tags = INTERN(' ' + ' '.join(tags))
+        if len(self.tags_cache) >= self.MAX_TAGS_CACHE_SIZE:
+            self.tags_cache.clear()
+        self.tags_cache[raw] = tags
+        return tags
+
+
+class GlobalTags(object):
+    """The tags given on the command line (host= and the -t options), that
+       every data point gets unless it already has a tag of the same name.
+       They're rendered once into a suffix for the lines, and what to append
+       to the lines that override some of them is cached by their tags."""
+
+    MAX_CACHE_SIZE = 10000
+
+    def __init__(self, tags):
+        self.items = sorted(tags.items())
+        self.suffix = ''.join(' %s=%s' % item for item in self.items)
+        self.cache = {}  # Maps the tags of a line to the suffix it gets.
+
+    def suffix_for(self, tags):
+        """Returns what to append to a line with the given tags, a string
+           of ' name=value' pairs like the LineParser returns."""
+        if not tags or not self.items:
+            return self.suffix
+        suffix = self.cache.get(tags)
+        if suffix is None:
+            names = set(tag.split('=', 1)[0] for tag in tags.split())
+            suffix = ''.join(' %s=%s' % (name, value)
+                             for name, value in self.items
+                             if name not in names)
+            if len(self.cache) >= self.MAX_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[tags] = suffix
+        return suffix
+
+    def tag_line(self, line):
+        """Returns a line we made ourselves with the global tags added."""
+        fields = line.split(None, 3)
+        tags = len(fields) > 3 and ' ' + fields[3] or ''
+        return line.rstrip() + self.suffix_for(tags)
+
+
 class ReaderThread(threading.Thread):
     """The main ReaderThread is responsible for reading from the collectors
        and assuring that we always read from the input no matter what.
-       All data read is put into the self.readerq Queue, which is
+       All data read is put into the self.readerq ReaderQueue, which is
        consumed by the SenderThread."""
 
-    def __init__(self, dedupinterval, evictinterval):
+    def __init__(self, dedupinterval, evictinterval, validation='lenient',
+                 tags=None):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -273,16 +2052,25 @@ class ReaderThread(threading.Thread):
                 combination of (metric, tags).  Values older than
                 evictinterval will be removed from the cache to save RAM.
                 Invariant: evictinterval > dedupinterval
+              validation: How picky the LineParser is about the lines of
+                data, either 'lenient' or 'strict'.
+              tags: A dictionary of tags to append to every data point,
+                unless it has its own value for them.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
         super(ReaderThread, self).__init__()
 
         self.readerq = ReaderQueue(MAX_READQ_SIZE)
+        self.batch = []  # Lines to put in the readerq all at once.
         self.lines_collected = 0
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
+        self.lastevict_time = 0
+        self.lastsummary_time = time.time()
+        self.parser = LineParser(validation)
+        self.tags = GlobalTags(tags or {})
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -291,30 +2079,65 @@ class ReaderThread(threading.Thread):
 
         LOG.debug("ReaderThread up and running")
 
-        lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
         while ALIVE:
-            for col in all_living_collectors():
+            if POLLER is None:
+                # we loop every second when we can't wait on the pipes of
+                # our children (stdin mode or no epoll available).
+                collectors = all_living_collectors()
+            else:
+                collectors = POLLER.poll(self.poll_timeout())
+            lines_collected = self.lines_collected
+            for col in collectors:
                 for line in col.collect():
                     self.process_line(col, line)
+                self.flush(col.priority)
 
-            if self.dedupinterval != 0:  # if 0 we do not use dedup
-                now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
-                    lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+            self.maybe_evict()
+            self.maybe_log_suppressed()
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(1)
+            if POLLER is None and self.lines_collected == lines_collected:
+                # and here is the loop that we really should get rid of, this
+                # just prevents us from spinning right now
+                time.sleep(1)
+
+    def poll_timeout(self):
+        """Returns how long we can wait for data before we have to evict old
+           values from the dedup caches or log the suppressed stderr."""
+        next_wakeup = self.lastsummary_time + STDERR_SUMMARY_INTERVAL
+        if self.dedupinterval != 0:
+            next_wakeup = min(next_wakeup,
+                              self.lastevict_time + self.evictinterval + 1)
+        return max(0, next_wakeup - time.time())
+
+    def maybe_evict(self):
+        """Evicts old values from the dedup caches every evictinterval."""
+        if self.dedupinterval != 0:  # if 0 we do not use dedup
+            now = int(time.time())
+            if now - self.lastevict_time > self.evictinterval:
+                self.lastevict_time = now
+                now -= self.evictinterval
+                for col in all_collectors():
+                    col.evict_old_keys(now)
+
+    def maybe_log_suppressed(self):
+        """Logs how many lines of stderr were suppressed every
+           STDERR_SUMMARY_INTERVAL, in case the collector went quiet since."""
+        now = time.time()
+        if now - self.lastsummary_time >= STDERR_SUMMARY_INTERVAL:
+            self.lastsummary_time = now
+            for col in all_collectors():
+                col.log_suppressed()
+
+    def flush(self, priority=0):
+        """Puts the lines processed so far in the reader queue."""
+        if self.batch:
+            queued = self.readerq.nput_batch(self.batch, priority)
+            self.lines_dropped += len(self.batch) - queued
+            self.batch = []
 
     def process_line(self, col, line):
-        """Parses the given line and appends the result to the reader queue."""
+        """Parses the given line and appends the result to the batch of lines
+           that flush() will put in the reader queue."""
 
         self.lines_collected += 1
 
@@ -323,17 +2146,14 @@ class ReaderThread(threading.Thread):
             LOG.warning('%s line too long: %s', col.name, line)
             col.lines_invalid += 1
             return
-        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
-                          '(\d+)\s+'               # Timestamp.
-                          '(\S+?)'                 # Value (int or float).
-                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
-                          line)
+        parsed = self.parser.parse(line)
         if parsed is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
-        metric, timestamp, value, tags = parsed.groups()
-        timestamp = int(timestamp)
+        metric, timestamp, value, tags = parsed
+        # the lines leave here with the global tags the sender would add.
+        suffix = self.tags.suffix_for(tags)
 
         # De-dupe detection...  To reduce the number of points we send to the
         # TSD, we suppress sending values of metrics that don't change to
@@ -346,65 +2166,247 @@ class ReaderThread(threading.Thread):
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
             key = (metric, tags)
-            if key in col.values:
+            entry = col.values.get(key)
+            if entry is not None:
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
+                if timestamp <= entry.timestamp:
                     LOG.error("Timestamp out of order: metric=%s%s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     col.lines_invalid += 1
                     return
                 elif timestamp >= MAX_REASONABLE_TIMESTAMP:
                     LOG.error("Timestamp is too far out in the future: metric=%s%s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              entry.timestamp, timestamp, value, col.name)
                     return
 
                 # if this data point is repeated, store it but don't send.
-                # store the previous timestamp, so when/if this value changes
+                # keep the previous timestamp, so when/if this value changes
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if (col.values[key][0] == value and
-                    (timestamp - col.values[key][3] < self.dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                if (entry.value == value and
+                    (timestamp - entry.timestamp < self.dedupinterval)):
+                    entry.repeated = True
+                    entry.last_timestamp = timestamp
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                    (timestamp - col.values[key][3] >= self.dedupinterval))
-                    and col.values[key][0] != value):
+                if ((entry.repeated or
+                    (timestamp - entry.timestamp >= self.dedupinterval))
+                    and entry.value != value):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
-                        self.lines_dropped += 1
+                    self.batch.append(entry.line(metric, tags) + suffix)
 
             # now we can reset for the next pass and send the line we actually
-            # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+            # want to send.  col.values is keyed by the metric and tags
+            # (essentially the same as what TSD uses for the row key).
+            col.values.set(key, value, timestamp)
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
-            self.lines_dropped += 1
+        self.batch.append(line + suffix)
+
+
+class Resolver(threading.Thread):
+    """Caches the addresses of the TSDs, and resolves them again in the
+       background when they expire, so the SenderThread doesn't have to
+       wait for the DNS when it reconnects.  When a name has several
+       addresses, they are handed out in turn."""
+
+    # How long to wait before trying again to resolve a name that failed.
+    RETRY_TIME = 10
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL):
+        """Constructor.
+
+        Args:
+          ttl: How many seconds to use the addresses of a name for.
+        """
+        super(Resolver, self).__init__()
+        self.setDaemon(True)  # Don't hang on exit over a slow resolver.
+        self.ttl = ttl
+        # Maps a (host, port) pair to a list of [refresh_time, addresses,
+        # index of the address to use first next time].
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getaddrinfo(host, port):
+        return socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                  socket.SOCK_STREAM, 0)
+
+    def resolve(self, host, port):
+        """Returns the addresses of the given host, like getaddrinfo.
+
+           Only blocks the first time we're asked about a given host (or
+           if the background thread isn't running).  Raises socket.gaierror
+           if the name can't be resolved."""
+        hostport = (host, port)
+        with self.lock:
+            entry = self.cache.get(hostport)
+        if entry is None or (entry[0] <= time.time()
+                             and not self.isAlive()):
+            self.refresh(hostport)
+        with self.lock:
+            entry = self.cache[hostport]
+            addresses = entry[1]
+            if not addresses:
+                raise socket.gaierror(socket.EAI_AGAIN,
+                                      'no address for %s:%d' % hostport)
+            # Round-robin over the addresses.
+            first = entry[2] % len(addresses)
+            entry[2] = first + 1
+        return addresses[first:] + addresses[:first]
+
+    def refresh(self, hostport):
+        """Resolves a name, and updates its addresses in the cache."""
+        try:
+            addresses = self.getaddrinfo(*hostport)
+            refresh_time = time.time() + self.ttl
+        except socket.gaierror, e:
+            LOG.warning('DNS resolution failure: %s: %s', hostport[0], e)
+            error = e
+            addresses = None
+            refresh_time = time.time() + self.RETRY_TIME
+        with self.lock:
+            entry = self.cache.get(hostport)
+            if entry is None:
+                if addresses is None:
+                    raise error
+                self.cache[hostport] = [refresh_time, addresses, 0]
+                return
+            entry[0] = refresh_time
+            if addresses is not None:  # Otherwise keep the stale ones.
+                entry[1] = addresses
+
+    def run(self):
+        """Refreshes the entries of the cache as they expire."""
+        while ALIVE:
+            now = time.time()
+            with self.lock:
+                expired = [hostport for hostport, entry
+                           in self.cache.iteritems() if entry[0] <= now]
+                next_refresh = min([entry[0] for entry
+                                    in self.cache.itervalues()]
+                                   or [now + self.RETRY_TIME])
+            if not expired:
+                time.sleep(max(min(next_refresh - now, 5), 0.1))
+                continue
+            for hostport in expired:
+                try:
+                    self.refresh(hostport)
+                except socket.gaierror:
+                    pass
+
+
+class ResolvedHTTPConnection(httplib.HTTPConnection):
+    """An HTTPConnection that gets the addresses of the TSD from a Resolver
+       each time it (re)connects, instead of looking them up itself."""
+
+    def __init__(self, host, port, resolver, timeout=15):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.resolver = resolver
+
+    def connect(self):
+        """Connects to the first address of the TSD that works.  Raises
+           socket.error (or socket.gaierror) if none does."""
+        error = None
+        for family, socktype, proto, canonname, sockaddr \
+                in self.resolver.resolve(self.host, self.port):
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(sockaddr)
+            except socket.error, e:
+                sock.close()
+                error = e
+                continue
+            self.sock = sock
+            return
+        raise error
+
+
+class TSDHealth(object):
+    """Keeps track of how well a TSD is doing, like a circuit breaker.
+
+       The circuit is 'closed' while the TSD works.  Any failure 'opens' it:
+       the TSD isn't used for a while, longer after each failure in a row.
+       Once that's over the circuit is 'half-open': we try the TSD again,
+       and either it works and the circuit closes, or it opens again.
+       Connection latency and errors are tracked as moving averages, which
+       make up a score to pick the best TSD among the available ones."""
+
+    CLOSED, HALF_OPEN, OPEN = range(3)
+    ALPHA = 0.3  # Weight of the latest measurement in the moving averages.
+    # How many seconds a TSD is left alone after its first failure in a
+    # row.  That doubles with each failure, up to MAX_OPEN_TIME.
+    MIN_OPEN_TIME = 1
+    MAX_OPEN_TIME = 30
+    ERROR_PENALTY = 10  # How many seconds of latency an error is worth.
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.latency = 0.0  # Moving average of the time to connect.
+        self.errors = 0.0   # Moving average of the failure rate.
+        self.failures = 0   # Failures in a row.
+        self.retry_time = 0  # When an open circuit becomes half-open.
+
+    def available(self, now=None):
+        """Returns whether we should try to use this TSD."""
+        return (self.state != self.OPEN
+                or (now or time.time()) >= self.retry_time)
+
+    def probe(self):
+        """Records that we're trying the TSD again, if its circuit was
+           open: it's half-open until we know how that went."""
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+
+    def score(self):
+        """Returns how bad this TSD is doing, the lower the better."""
+        return self.latency + self.errors * self.ERROR_PENALTY
+
+    def connected(self, latency):
+        """Records how many seconds it took to connect to the TSD."""
+        self.latency += self.ALPHA * (latency - self.latency)
+
+    def success(self):
+        """Records that we successfully talked to the TSD."""
+        if self.state != self.CLOSED or self.failures:
+            self.state = self.CLOSED
+            self.failures = 0
+        self.errors -= self.ALPHA * self.errors
+
+    def failure(self):
+        """Records that the TSD failed us, and opens the circuit."""
+        self.errors += self.ALPHA * (1 - self.errors)
+        self.failures += 1
+        self.state = self.OPEN
+        open_time = min(self.MIN_OPEN_TIME * 2 ** min(self.failures - 1, 16),
+                        self.MAX_OPEN_TIME)
+        # Some randomness so all the tcollectors don't come back at once.
+        self.retry_time = time.time() + open_time * (0.5 + random.random() / 2)
 
 
 class SenderThread(threading.Thread):
     """The SenderThread is responsible for maintaining a connection
        to the TSD and sending the data we're getting over to it.  This
-       thread is also responsible for doing any sort of emergency
-       buffering we might need to do if we can't establish a connection
-       and we need to spool to disk.  That isn't implemented yet."""
-
-    def __init__(self, reader, dryrun, hosts, self_report_stats, tags, reconnectinterval):
+       thread is also responsible for sending the data that the reader
+       spooled to disk while we couldn't establish a connection."""
+
+    def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
+                 reconnectinterval,
+                 max_send_latency=DEFAULT_MAX_SEND_LATENCY,
+                 max_batch_bytes=DEFAULT_MAX_BATCH_BYTES, http=False,
+                 http_batch_size=DEFAULT_HTTP_BATCH_SIZE, http_gzip=False,
+                 spool=None, spool_replay_rate=DEFAULT_SPOOL_REPLAY_RATE,
+                 resolver=None):
         """Constructor.
 
         Args:
@@ -415,84 +2417,143 @@ class SenderThread(threading.Thread):
           self_report_stats: If true, the reader thread will insert its own
             stats into the metrics reported to TSD, as if those metrics had
             been read from a collector.
-          tags: A dictionary of tags to append for every data point.
+          tags: A dictionary of tags to append to the data points we
+            make ourselves (the ReaderThread tags the others).
+          max_send_latency: How many seconds data can wait in the reader
+            queue before we send it.
+          max_batch_bytes: Send as soon as this many bytes of data are
+            waiting, and never send more than this at once.
+          http: If true, data points are POSTed as JSON to the /api/put
+            endpoint of the TSD instead of using the telnet-style protocol.
+          http_batch_size: How many data points to send per HTTP request.
+          http_gzip: If true, gzip the body of the HTTP requests.
+          spool: A DiskSpool where the reader puts the data it couldn't
+            queue, which we send once we're connected to a TSD.
+          spool_replay_rate: At most how many lines per second to send
+            from the spool.
+          resolver: The Resolver to find the addresses of the TSDs with.
         """
         super(SenderThread, self).__init__()
 
         self.dryrun = dryrun
         self.reader = reader
-        self.tags = sorted(tags.items())
+        self.tags = GlobalTags(tags)
         self.hosts = hosts  # A list of (host, port) pairs.
         # Randomize hosts to help even out the load.
         random.shuffle(self.hosts)
-        self.blacklisted_hosts = set()  # The 'bad' (host, port) pairs.
+        # Maps each (host, port) pair to its TSDHealth.
+        self.health = dict((hostport, TSDHealth()) for hostport in hosts)
         self.current_tsd = -1  # Index in self.hosts where we're at.
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
-        self.tsd = None   # The socket connected to the aforementioned TSD.
+        # The socket connected to the aforementioned TSD, or the
+        # httplib.HTTPConnection to it in HTTP mode.
+        self.tsd = None
         self.last_verify = 0
         self.reconnectinterval = reconnectinterval    # reconnectinterval in seconds.
         self.time_reconnect = 0                 # if reconnectinterval > 0, used to track the time.
         self.sendq = []
         self.self_report_stats = self_report_stats
+        self.max_send_latency = max_send_latency
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_bytes = Histogram([1024, 4096, 16384, 65536, 262144,
+                                      1048576, 4194304])
+        self.http = http
+        self.http_batch_size = http_batch_size
+        self.http_gzip = http_gzip
+        self.points_sent = 0      # Data points accepted by the TSD (HTTP).
+        self.points_rejected = 0  # Data points the TSD refused.
+        # Maps a metric name to how many of its data points were refused.
+        self.rejected_metrics = {}
+        self.responses = ''  # Incomplete line of what the TSD told us.
+        self.lines_sent = 0  # Lines successfully handed to the TSD.
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+        self.last_replay = time.time()
+        self.lines_replayed = 0
+        self.resolver = resolver or Resolver()
 
     def pick_connection(self):
-        """Picks up a random host/port connection."""
-        # Try to get the next host from the list, until we find a host that
-        # isn't in the blacklist, or until we run out of hosts (i.e. they
-        # are all blacklisted, which typically happens when we lost our
-        # connectivity to the outside world).
-        for self.current_tsd in xrange(self.current_tsd + 1, len(self.hosts)):
-            hostport = self.hosts[self.current_tsd]
-            if hostport not in self.blacklisted_hosts:
-                break
-        else:
+        """Picks up the healthiest host/port connection."""
+        # Among the hosts we can try, take the one with the best score.
+        # Ties go to the next host in the list after the one we're at, so
+        # we go around the list when they're all the same.  If no host can
+        # be tried (i.e. they all failed recently, which typically happens
+        # when we lost our connectivity to the outside world), give them
+        # all another chance.
+        now = time.time()
+        order = [self.hosts[(self.current_tsd + 1 + i) % len(self.hosts)]
+                 for i in xrange(len(self.hosts))]
+        candidates = [hostport for hostport in order
+                      if self.health[hostport].available(now)]
+        if not candidates:
             LOG.info('No more healthy hosts, retry with previously blacklisted')
-            random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
-            self.current_tsd = 0
-            hostport = self.hosts[self.current_tsd]
+            candidates = order
+        hostport = min(candidates, key=lambda hp: self.health[hp].score())
+        self.health[hostport].probe()
+        self.current_tsd = self.hosts.index(hostport)
 
         self.host, self.port = hostport
         LOG.info('Selected connection: %s:%d', self.host, self.port)
 
     def blacklist_connection(self):
-        """Marks the current TSD host we're trying to use as blacklisted.
-
-           Blacklisted hosts will get another chance to be elected once there
-           will be no more healthy hosts."""
-        # FIXME: Enhance this naive strategy.
-        LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+        """Records a failure of the current TSD host, which won't be used
+           for a while (see TSDHealth)."""
+        health = self.health.get((self.host, self.port))
+        if health is None:
+            return
+        health.failure()
+        LOG.info('Blacklisting %s:%s for %0.1f seconds', self.host, self.port,
+                 max(health.retry_time - time.time(), 0))
+
+    def connection_ok(self):
+        """Records that the current TSD host is working."""
+        health = self.health.get((self.host, self.port))
+        if health is not None:
+            health.success()
+
+    def reconnect_delay(self):
+        """Returns how long to wait before a host can be tried again."""
+        now = time.time()
+        if any(health.available(now) for health in self.health.itervalues()):
+            return 0
+        return min(min(health.retry_time for health in self.health.itervalues())
+                   - now, TSDHealth.MAX_OPEN_TIME)
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, wait until it's been queued for max_send_latency seconds
+           or until max_batch_bytes bytes are queued, whichever comes first,
+           and grab all of the pending data and send it.  A little better
+           than sending every line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         while ALIVE:
             try:
                 self.maintain_conn()
-                try:
-                    line = self.reader.readerq.get(True, 5)
-                except Empty:
+                replaying = self.spool is not None and self.spool.pending()
+                if replaying:
+                    self.replay_spool()
+                readerq = self.reader.readerq
+                if not readerq.wait(replaying and 1 or 5):
                     continue
-                self.sendq.append(line)
-                time.sleep(5)  # Wait for more data
-                while True:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    if len(self.sendq) > MAX_SENDQ_SIZE:
-                        break
-                    try:
-                        line = self.reader.readerq.get(False)
-                    except Empty:
-                        break
-                    self.sendq.append(line)
+                oldest = readerq.oldest()
+                if oldest is not None:  # Wait for more data
+                    readerq.wait(oldest + self.max_send_latency - time.time(),
+                                 self.max_batch_bytes)
+                # prevents self.sendq fast growing in case of sending fails
+                # in send_data()
+                room = max(MAX_SENDQ_SIZE + 1 - len(self.sendq), 1)
+                max_bytes = max(min(self.max_batch_bytes,
+                                    MAX_SENDQ_BYTES - self.sendq_bytes()), 1)
+                nbytes = 0
+                for batch in readerq.get_batches(room, max_bytes):
+                    self.sendq.extend(batch)
+                    nbytes += sum(map(len, batch))
+                if nbytes:
+                    self.batch_bytes.add(nbytes)
 
                 if ALIVE:
                     self.send_data()
@@ -511,6 +2572,30 @@ class SenderThread(threading.Thread):
                 shutdown()
                 raise
 
+    def sendq_bytes(self):
+        """Returns how many bytes of data are in the sendq."""
+        return sum(map(len, self.sendq))
+
+    def replay_spool(self):
+        """Sends data from the spool, no faster than spool_replay_rate lines
+           per second, now that we're connected to a TSD."""
+        now = time.time()
+        allowed = int((now - self.last_replay) * self.spool_replay_rate)
+        room = MAX_SENDQ_SIZE + 1 - len(self.sendq)
+        if self.sendq_bytes() >= MAX_SENDQ_BYTES:
+            room = 0
+        lines = self.spool.read(min(allowed, room, self.spool_replay_rate))
+        if not lines:
+            if allowed > 0:
+                self.last_replay = now
+            return
+        LOG.debug('replaying %d lines from the spool', len(lines))
+        self.last_replay = now
+        self.lines_replayed += len(lines)
+        self.sendq.extend(lines)
+        if ALIVE:
+            self.send_data()
+
     def verify_conn(self):
         """Periodically verify that our connection to the TSD is OK
            and that the TSD is alive/working."""
@@ -530,71 +2615,188 @@ class SenderThread(threading.Thread):
                 pass    # not handling that
             self.time_reconnect = time.time()
             return False
-            
-        # we use the version command as it is very low effort for the TSD
-        # to respond
-        LOG.debug('verifying our TSD connection is alive')
-        try:
-            self.tsd.sendall('version\n')
-        except socket.error, msg:
-            self.tsd = None
-            self.blacklist_connection()
-            return False
-
-        bufsize = 4096
-        while ALIVE:
-            # try to read as much data as we can.  at some point this is going
-            # to block, but we have set the timeout low when we made the
-            # connection
-            try:
-                buf = self.tsd.recv(bufsize)
-            except socket.error, msg:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
 
-            # If we don't get a response to the `version' request, the TSD
-            # must be dead or overloaded.
-            if not buf:
-                self.tsd = None
-                self.blacklist_connection()
+        if self.http:
+            if not self.verify_http_conn():
                 return False
+            self.connection_ok()
+            self.report_self_stats()
+            self.last_verify = time.time()
+            return True
 
-            # Woah, the TSD has a lot of things to tell us...  Let's make
-            # sure we read everything it sent us by looping once more.
-            if len(buf) == bufsize:
-                continue
+        # Whatever the TSD has to tell us is read after each send, so we
+        # don't need to send it a request and sift through all that to see
+        # if it's alive: if it closed the connection, we'll notice here,
+        # and TCP keepalives take care of the peers that vanished.
+        LOG.debug('verifying our TSD connection is alive')
+        if not self.drain_responses():
+            return False
 
-            # If everything is good, send out our meta stats.  This
-            # helps to see what is going on with the tcollector.
-            if self.self_report_stats:
-                strs = [
-                        ('reader.lines_collected',
-                         '', self.reader.lines_collected),
-                        ('reader.lines_dropped',
-                         '', self.reader.lines_dropped)
-                       ]
-
-                for col in all_living_collectors():
-                    strs.append(('collector.lines_sent', 'collector='
-                                 + col.name, col.lines_sent))
-                    strs.append(('collector.lines_received', 'collector='
-                                 + col.name, col.lines_received))
-                    strs.append(('collector.lines_invalid', 'collector='
-                                 + col.name, col.lines_invalid))
-
-                ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s"
-                          % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
-
-            break  # TSD is alive.
-
-        # if we get here, we assume the connection is good
+        # If everything is good, send out our meta stats.  This
+        # helps to see what is going on with the tcollector.
+        self.connection_ok()
+        self.report_self_stats()
         self.last_verify = time.time()
         return True
 
+    def drain_responses(self):
+        """Reads whatever the TSD sent us without blocking, and accounts
+           for the data points it rejected.
+
+        Returns:
+          False if the connection to the TSD is gone, True otherwise.
+        """
+        bufsize = 4096
+        try:
+            while True:
+                try:
+                    if not select.select([self.tsd], [], [], 0)[0]:
+                        return True
+                    buf = self.tsd.recv(bufsize)
+                except (select.error, socket.error), e:
+                    # a signal (e.g. SIGCHLD) isn't a problem with the TSD.
+                    if e.args and e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not buf:
+                    LOG.warning('TSD %s:%d closed the connection',
+                                self.host, self.port)
+                    break
+                self.responses += buf
+                lines = self.responses.split('\n')
+                self.responses = lines.pop()
+                for line in lines:
+                    self.count_tsd_error(line)
+        except (select.error, socket.error), e:
+            LOG.warning('failed to read from the TSD: %s', e)
+        try:
+            self.tsd.close()
+        except socket.error:
+            pass
+        self.tsd = None
+        self.responses = ''
+        self.blacklist_connection()
+        return False
+
+    def count_tsd_error(self, line):
+        """Accounts for one line of the TSD's answers to our puts, like:
+           put: unknown metric: No such name for 'metrics': 'foo.bar'"""
+        line = line.strip()
+        if not line.startswith('put:'):
+            if line:
+                LOG.debug('TSD said: %s', line)
+            return
+        LOG.warning('TSD rejected a data point: %s', line)
+        parsed = TSD_ERROR_METRIC_RE.search(line)
+        if parsed is None:
+            metric = 'unknown'
+        else:
+            metric = INVALID_TAG_CHARS_RE.sub('_', parsed.group(1))
+        self.count_rejected(metric, 1)
+
+    def count_rejected(self, metric, npoints):
+        """Records that the TSD refused npoints data points of a metric."""
+        self.points_rejected += npoints
+        if (metric not in self.rejected_metrics
+            and len(self.rejected_metrics) >= MAX_REJECTED_METRICS):
+            metric = 'other'
+        self.rejected_metrics[metric] = (self.rejected_metrics.get(metric, 0)
+                                         + npoints)
+
+    def verify_http_conn(self):
+        """Checks that the TSD answers to a request on /api/version."""
+        LOG.debug('verifying our TSD connection is alive')
+        try:
+            self.tsd.request('GET', '/api/version')
+            response = self.tsd.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error), e:
+            LOG.warning('HTTP request to %s:%d failed: %s',
+                        self.host, self.port, e)
+            response = None
+        if response is None or response.status != 200:
+            self.tsd.close()
+            self.tsd = None
+            self.blacklist_connection()
+            return False
+        return True
+
+    def report_self_stats(self):
+        """Appends our meta stats to the sendq, if we're reporting them.
+           This helps to see what is going on with the tcollector."""
+        if not self.self_report_stats:
+            return
+        strs = [
+                ('reader.lines_collected',
+                 '', self.reader.lines_collected),
+                ('reader.lines_dropped',
+                 '', self.reader.lines_dropped),
+                ('reader.lines_evicted',
+                 '', self.reader.readerq.lines_evicted),
+                ('reader.queued_lines', '', self.reader.readerq.qsize()),
+                ('reader.queued_bytes', '', self.reader.readerq.memory()),
+                ('sender.sendq_bytes', '', self.sendq_bytes()),
+                ('intern.size', '', len(INTERN)),
+                ('intern.hits', '', INTERN.hits),
+                ('intern.misses', '', INTERN.misses),
+                ('intern.hit_rate', '', INTERN.hit_rate()),
+                ('intern.bytes_saved', '', INTERN.bytes_saved),
+               ]
+        strs.extend(self.batch_bytes.stats('sender.batch_bytes'))
+        strs.extend(self.reader.readerq.queue_time.stats(
+            'reader.queue_time_ms'))
+        strs.extend(SCHEDULE_LAG.stats('scheduler.lag_ms'))
+        if self.http:
+            strs.append(('sender.points_sent', '', self.points_sent))
+        strs.append(('sender.points_rejected', '', self.points_rejected))
+        for (host, port), health in sorted(self.health.iteritems()):
+            tsd = 'tsd=%s_%d' % (host.replace(':', '_'), port)
+            strs.append(('sender.tsd_state', tsd, health.state))
+            strs.append(('sender.tsd_failures', tsd, health.failures))
+        for metric, npoints in sorted(self.rejected_metrics.iteritems()):
+            strs.append(('sender.points_rejected', 'metric=' + metric,
+                         npoints))
+        if self.spool is not None:
+            strs.append(('reader.lines_spooled', '',
+                         self.reader.readerq.lines_spooled))
+            strs.append(('spool.bytes', '', self.spool.bytes))
+            strs.append(('spool.bytes_evicted', '', self.spool.bytes_evicted))
+            strs.append(('spool.lines_replayed', '', self.lines_replayed))
+
+        for col in all_living_collectors():
+            strs.append(('collector.lines_sent', 'collector='
+                         + col.name, col.lines_sent))
+            strs.append(('collector.lines_received', 'collector='
+                         + col.name, col.lines_received))
+            strs.append(('collector.lines_invalid', 'collector='
+                         + col.name, col.lines_invalid))
+            strs.append(('collector.dedup_series', 'collector='
+                         + col.name, len(col.values)))
+            strs.append(('collector.dedup_bytes', 'collector='
+                         + col.name, col.values.memory_usage()))
+            if col.interval:
+                strs.append(('collector.schedule_lag_ms', 'collector='
+                             + col.name, int(col.schedule_lag * 1000)))
+
+        for col in list(all_collectors()):
+            cpu, rss, read_bytes, runtime = col.usage.totals()
+            tags = 'collector=' + col.name
+            strs.append(('collector.cpu_seconds', tags, round(cpu, 2)))
+            strs.append(('collector.rss_bytes', tags, rss))
+            strs.append(('collector.read_bytes', tags, read_bytes))
+            strs.append(('collector.spawn_count', tags,
+                         col.usage.spawn_count))
+            strs.append(('collector.runtime', tags, int(runtime)))
+            if CGROUPS is not None:
+                for name, value in CGROUPS.stats(col):
+                    strs.append(('collector.' + name, tags, value))
+
+        ts = int(time.time())
+        strout = [self.tags.tag_line("tcollector.%s %d %s %s"
+                                     % (x[0], ts, x[2], x[1])) for x in strs]
+        for string in strout:
+            self.sendq.append(string)
+
     def maintain_conn(self):
         """Safely connect to the TSD and ensure that it's up and
            running and that we're not talking to a ghost connection
@@ -606,39 +2808,46 @@ class SenderThread(threading.Thread):
 
         # connection didn't verify, so create a new one.  we might be in
         # this method for a long time while we sort this out.
-        try_delay = 1
         while ALIVE:
             if self.verify_conn():
                 return
 
-            # increase the try delay by some amount and some random value,
-            # in case the TSD is down for a while.  delay at most
-            # approximately 10 minutes.
-            try_delay *= 1 + random.random()
-            if try_delay > 600:
-                try_delay *= 0.5
-            LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
-            time.sleep(try_delay)
+            # if all the TSDs failed recently, wait until one of them
+            # gets another chance.
+            try_delay = self.reconnect_delay()
+            if try_delay > 0:
+                LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
+                time.sleep(try_delay)
 
             # Now actually try the connection.
             self.pick_connection()
+            if self.http:
+                # httplib connects by itself, and keeps the connection alive
+                # between requests.
+                self.tsd = ResolvedHTTPConnection(self.host, self.port,
+                                                  self.resolver)
+                continue
             try:
-                addresses = socket.getaddrinfo(self.host, self.port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM, 0)
+                addresses = self.resolver.resolve(self.host, self.port)
             except socket.gaierror, e:
                 # Don't croak on transient DNS resolution issues.
                 if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
                             socket.EAI_NODATA):
                     LOG.debug('DNS resolution failure: %s: %s', self.host, e)
+                    self.blacklist_connection()
                     continue
                 raise
             for family, socktype, proto, canonname, sockaddr in addresses:
                 try:
                     self.tsd = socket.socket(family, socktype, proto)
                     self.tsd.settimeout(15)
+                    self.tsd.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_KEEPALIVE, 1)
+                    start = time.time()
                     self.tsd.connect(sockaddr)
                     # if we get here it connected
+                    self.health[(self.host, self.port)].connected(
+                        time.time() - start)
                     LOG.debug('Connection to %s was successful'%(str(sockaddr)))
                     break
                 except socket.error, msg:
@@ -646,43 +2855,136 @@ class SenderThread(threading.Thread):
                                 self.host, self.port, msg)
                 self.tsd.close()
                 self.tsd = None
+            self.responses = ''
             if not self.tsd:
                 LOG.error('Failed to connect to %s:%d', self.host, self.port)
                 self.blacklist_connection()
 
-    def add_tags_to_line(self, line):
-        for tag, value in self.tags:
-            if ' %s=' % tag not in line:
-                line += ' %s=%s' % (tag, value)
-        return line
+    def line_to_datapoint(self, line):
+        """Turns a line of data into a data point for the HTTP API."""
+        fields = line.split()
+        value = fields[2]
+        try:
+            value = int(value)
+        except ValueError:
+            try:
+                value = float(value)
+            except ValueError:
+                pass  # Let the TSD tell us what it thinks about this.
+        tags = dict(tag.split('=', 1) for tag in fields[3:])
+        for tag, tagvalue in self.tags.items:
+            if tag not in tags:
+                tags[tag] = tagvalue
+        return {'metric': fields[0], 'timestamp': int(fields[1]),
+                'value': value, 'tags': tags}
+
+    def send_data_via_http(self):
+        """Sends outstanding data in self.sendq to the /api/put endpoint of
+           the TSD, http_batch_size data points per request.  Whatever we
+           couldn't send stays in self.sendq for the next attempt."""
+
+        sent = 0  # How many lines of the sendq went through.
+        try:
+            while sent < len(self.sendq):
+                lines = self.sendq[sent:sent + self.http_batch_size]
+                body = json.dumps([self.line_to_datapoint(line)
+                                   for line in lines])
+                if self.dryrun:
+                    print body
+                    sent += len(lines)
+                    continue
+                headers = {'Content-Type': 'application/json'}
+                if self.http_gzip:
+                    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                  zlib.DEFLATED,
+                                                  16 + zlib.MAX_WBITS)
+                    body = compressor.compress(body) + compressor.flush()
+                    headers['Content-Encoding'] = 'gzip'
+                self.tsd.request('POST', '/api/put?details', body, headers)
+                response = self.tsd.getresponse()
+                payload = response.read()
+                if response.status == 400:
+                    # Some of the data points were rejected, the others
+                    # were stored.  Retrying won't help.
+                    self.count_http_errors(payload, len(lines))
+                elif response.status not in (200, 204):
+                    raise httplib.HTTPException('HTTP status %d: %s'
+                                                % (response.status,
+                                                   payload[:200]))
+                else:
+                    self.points_sent += len(lines)
+                sent += len(lines)
+                self.connection_ok()
+        except (httplib.HTTPException, socket.error), e:
+            LOG.error('failed to send data: %s', e)
+            self.tsd.close()
+            self.tsd = None
+            self.blacklist_connection()
+        self.lines_sent += sent
+        del self.sendq[:sent]
+
+    def count_http_errors(self, payload, npoints):
+        """Accounts for the data points the TSD rejected, given the details
+           of its answer to a request with npoints data points."""
+        try:
+            details = json.loads(payload)
+            failed = int(details['failed'])
+            success = int(details.get('success', npoints - failed))
+            errors = details.get('errors') or []
+        except (ValueError, KeyError, TypeError):
+            LOG.error('TSD rejected %d data points: %s', npoints, payload[:200])
+            self.count_rejected('unknown', npoints)
+            return
+        self.points_sent += success
+        for error in errors:
+            LOG.warning('TSD rejected %s: %s', error.get('datapoint'),
+                        error.get('error'))
+            metric = (error.get('datapoint') or {}).get('metric') or 'unknown'
+            self.count_rejected(INVALID_TAG_CHARS_RE.sub('_', metric), 1)
+        # The TSD only details the first few errors.
+        if failed > len(errors):
+            self.count_rejected('unknown', failed - len(errors))
 
     def send_data(self):
-        """Sends outstanding data in self.sendq to the TSD in one operation."""
+        """Sends outstanding data in self.sendq to the TSD.  Whatever we
+           couldn't send stays in self.sendq for the next attempt."""
+
+        if self.http:
+            self.send_data_via_http()
+            return
 
-        # construct the output string
-        out = ''
+        if not self.sendq:
+            LOG.debug('send_data no data?')
+            return
 
-        # in case of logging we use less efficient variant
         if LOG.level == logging.DEBUG:
             for line in self.sendq:
-                line = "put %s" % self.add_tags_to_line(line)
-                out += line + "\n"
-                LOG.debug('SENDING: %s', line)
-        else:
-            out = "".join("put %s\n" % self.add_tags_to_line(line) for line in self.sendq)
-
-        if not out:
-            LOG.debug('send_data no data?')
+                LOG.debug('SENDING: put %s', line)
+        if self.dryrun:
+            # the lines already have their tags, see GlobalTags.
+            print 'put %s\n' % '\nput '.join(self.sendq)
+            self.lines_sent += len(self.sendq)
+            self.sendq = []
             return
 
-        # try sending our data.  if an exception occurs, just error and
-        # try sending again next time.
+        # send about SEND_CHUNK_BYTES at a time (going by the average length
+        # of the lines) rather than the whole sendq in one string, and keep
+        # track of the lines the kernel took, so that if an exception occurs
+        # we only send the rest again next time.
+        sent = 0  # How many lines of the sendq went through.
+        size = sum(map(len, self.sendq)) + 5 * len(self.sendq)
+        per_chunk = max(1, SEND_CHUNK_BYTES * len(self.sendq) // size)
         try:
-            if self.dryrun:
-                print out
-            else:
-                self.tsd.sendall(out)
-            self.sendq = []
+            while sent < len(self.sendq):
+                lines = self.sendq[sent:sent + per_chunk]
+                chunk = 'put %s\n' % '\nput '.join(lines)
+                offset = 0
+                try:
+                    while offset < len(chunk):
+                        offset += self.tsd.send(buffer(chunk, offset))
+                finally:
+                    sent += chunk.count('\n', 0, offset)
+            self.connection_ok()
         except socket.error, msg:
             LOG.error('failed to send data: %s', msg)
             try:
@@ -691,9 +2993,239 @@ class SenderThread(threading.Thread):
                 pass
             self.tsd = None
             self.blacklist_connection()
+            return
+        finally:
+            self.lines_sent += sent
+            del self.sendq[:sent]
 
-        # FIXME: we should be reading the result at some point to drain
-        # the packets out of the kernel's queue
+        # Don't let the TSD's error messages pile up in the kernel's queue.
+        self.drain_responses()
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto a set of nodes: each node is placed
+       at REPLICAS pseudo-random points of a ring, and a key belongs to the
+       first node found clockwise from the point the key hashes to.  Adding
+       or removing a node only moves the keys of that node."""
+
+    REPLICAS = 100
+
+    def __init__(self, nodes):
+        """Constructor.
+
+        Args:
+          nodes: A list of (host, port) tuples.
+        """
+        self.nodes = list(nodes)
+        ring = []
+        for node in self.nodes:
+            for i in xrange(self.REPLICAS):
+                ring.append((self.hash('%s:%d-%d' % (node + (i,))), node))
+        ring.sort()
+        self.hashes = [h for h, node in ring]
+        self.ring = [node for h, node in ring]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def lookup(self, key):
+        """Generator that yields every node, in the order in which they're
+           responsible for the given key (the first one is the owner, the
+           next ones take over when the previous ones are unavailable)."""
+        start = bisect.bisect(self.hashes, self.hash(key))
+        seen = set()
+        for i in xrange(len(self.ring)):
+            node = self.ring[(start + i) % len(self.ring)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+
+class ShardReader(object):
+    """Stands in for the ReaderThread for the SenderThread of one shard: it
+       has its own queue, with its share of the limits of the reader's
+       queue, but reports the stats of the actual reader."""
+
+    def __init__(self, sender, nshards):
+        self.sender = sender
+        self.reader = sender.reader
+        readerq = self.reader.readerq
+        max_bytes = readerq.max_bytes
+        if max_bytes is not None:
+            max_bytes = max(max_bytes // nshards, 1)
+        self.readerq = ReaderQueue(max(readerq.maxsize // nshards, 1),
+                                   max_bytes, readerq.drop_policy)
+        # What doesn't fit goes to the spool, which the ShardedSender
+        # replays, so it still ends up in the right shard.
+        self.readerq.spool = readerq.spool
+
+    @property
+    def lines_collected(self):
+        return self.reader.lines_collected
+
+    @property
+    def lines_dropped(self):
+        return self.reader.lines_dropped + sum(self.sender.lines_dropped
+                                               .itervalues())
+
+
+class ShardedSender(threading.Thread):
+    """Spreads the data over all the TSDs at once: each TSD gets its own
+       SenderThread and queue, and each line is routed to one of them based
+       on a consistent hash of its metric name and tags.  While the TSD of a
+       shard is unreachable, its lines go to the next shard on the ring.
+       The shards split the limits of the reader queue between them, and
+       we replay the spool ourselves so that its lines get routed too."""
+
+    # How many series to remember the owner of.
+    MAX_ROUTES = 100000
+
+    def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
+                 reconnectinterval,
+                 max_send_latency=DEFAULT_MAX_SEND_LATENCY,
+                 max_batch_bytes=DEFAULT_MAX_BATCH_BYTES, http=False,
+                 http_batch_size=DEFAULT_HTTP_BATCH_SIZE, http_gzip=False,
+                 spool=None, spool_replay_rate=DEFAULT_SPOOL_REPLAY_RATE,
+                 resolver=None):
+        """Constructor.  Takes the same arguments as the SenderThread."""
+        super(ShardedSender, self).__init__()
+        self.reader = reader
+        self.dryrun = dryrun
+        self.self_report_stats = self_report_stats
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+        self.last_replay = time.time()
+        self.lines_replayed = 0
+        self.ring = HashRing(sorted(hosts))
+        self.shards = {}  # Maps a (host, port) to its SenderThread.
+        # Lines that didn't fit in the queue of each shard.
+        self.lines_dropped = dict((hostport, 0) for hostport in hosts)
+        for i, hostport in enumerate(self.ring.nodes):
+            # Only one of the shards reports the global stats.
+            self.shards[hostport] = SenderThread(
+                ShardReader(self, len(self.ring.nodes)), dryrun, [hostport],
+                self_report_stats and i == 0, tags, reconnectinterval,
+                max_send_latency, max_batch_bytes, http, http_batch_size,
+                http_gzip, resolver=resolver)
+        self.tags = self.shards[self.ring.nodes[0]].tags
+        self.routes = {}  # Maps a series to the (host, port) that owns it.
+        self.lines_routed = dict((hostport, 0) for hostport in self.shards)
+        self.last_report = time.time()
+
+    def healthy(self, hostport):
+        """Returns whether we can send data to the given shard."""
+        return self.dryrun or self.shards[hostport].tsd is not None
+
+    def route(self, line):
+        """Returns the (host, port) of the shard to send the line to."""
+        fields = line.split()
+        key = fields[0] + ' ' + ' '.join(sorted(fields[3:]))
+        owner = self.routes.get(key)
+        if owner is None:
+            owner = self.routes[key] = self.ring.lookup(key).next()
+            if len(self.routes) > self.MAX_ROUTES:
+                self.routes.clear()
+        if self.healthy(owner):
+            return owner
+        for hostport in self.ring.lookup(key):
+            if self.healthy(hostport):
+                return hostport
+        return owner  # Everything is down, let the owner queue it up.
+
+    def dispatch(self, lines):
+        """Routes the given lines to the queues of the shards."""
+        batches = {}
+        for line in lines:
+            hostport = self.route(line)
+            batch = batches.get(hostport)
+            if batch is None:
+                batch = batches[hostport] = []
+            batch.append(line)
+        for hostport, batch in batches.iteritems():
+            self.lines_routed[hostport] += len(batch)
+            queued = self.shards[hostport].reader.readerq.nput_batch(batch)
+            self.lines_dropped[hostport] += len(batch) - queued
+
+    def reroute(self):
+        """Takes back the data queued for the shards that are down, and
+           routes it again, if any shard is up."""
+        down = [hostport for hostport in self.shards
+                if not self.healthy(hostport)]
+        if not down or len(down) == len(self.shards):
+            return
+        for hostport in down:
+            readerq = self.shards[hostport].reader.readerq
+            for batch in readerq.get_batches(readerq.qsize()):
+                self.lines_routed[hostport] -= len(batch)
+                self.dispatch(batch)
+
+    def replay_spool(self):
+        """Routes data from the spool, no faster than spool_replay_rate
+           lines per second, while at least one shard is up."""
+        if (self.spool is None
+            or not any(self.healthy(hostport) for hostport in self.shards)):
+            return
+        now = time.time()
+        allowed = int((now - self.last_replay) * self.spool_replay_rate)
+        lines = self.spool.read(min(allowed, self.spool_replay_rate))
+        if not lines:
+            if allowed > 0:
+                self.last_replay = now
+            return
+        LOG.debug('replaying %d lines from the spool', len(lines))
+        self.last_replay = now
+        self.lines_replayed += len(lines)
+        self.dispatch(lines)
+
+    def report_self_stats(self):
+        """Routes our per-shard stats like any other data, every minute."""
+        now = time.time()
+        if not self.self_report_stats or now - self.last_report < 60:
+            return
+        self.last_report = now
+        lines = []
+        for (host, port), shard in sorted(self.shards.iteritems()):
+            tags = 'shard=%s_%d' % (host.replace(':', '_'), port)
+            for name, value in (
+                ('lines_routed', self.lines_routed[(host, port)]),
+                ('lines_sent', shard.lines_sent),
+                ('lines_dropped', self.lines_dropped[(host, port)]),
+                ('queued', shard.reader.readerq.qsize()),
+                ('healthy', int(self.healthy((host, port))))):
+                lines.append(self.tags.tag_line(
+                    'tcollector.sender.shard.%s %d %d %s'
+                    % (name, now, value, tags)))
+        if self.spool is not None:
+            for name, value in (
+                ('reader.lines_spooled', self.reader.readerq.lines_spooled
+                 + sum(shard.reader.readerq.lines_spooled
+                       for shard in self.shards.itervalues())),
+                ('spool.bytes', self.spool.bytes),
+                ('spool.bytes_evicted', self.spool.bytes_evicted),
+                ('spool.lines_replayed', self.lines_replayed)):
+                lines.append(self.tags.tag_line('tcollector.%s %d %d'
+                                                % (name, now, value)))
+        self.dispatch(lines)
+
+    def run(self):
+        """Main loop: starts the SenderThread of each shard and moves the
+           data from the reader's queue to theirs."""
+        for shard in self.shards.itervalues():
+            shard.start()
+        readerq = self.reader.readerq
+        while ALIVE:
+            self.reroute()
+            self.replay_spool()
+            self.report_self_stats()
+            if not readerq.wait(1):
+                continue
+            for batch in readerq.get_batches(MAX_READQ_SIZE):
+                self.dispatch(batch)
+        for shard in self.shards.itervalues():
+            shard.join()
 
 
 def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
@@ -712,6 +3244,17 @@ def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
     LOG.addHandler(ch)
 
 
+def setup_async_logging():
+    """Makes the handlers set up by setup_logging write from a thread, so
+       that the collectors and the other threads never wait for the disk.
+       This starts a thread, so it has to be done after forking the
+       ForkServer."""
+    for handler in LOG.handlers[:]:
+        if not isinstance(handler, AsyncLogHandler):
+            LOG.removeHandler(handler)
+            LOG.addHandler(AsyncLogHandler(handler))
+
+
 def parse_cmdline(argv):
     """Parses the command-line."""
 
@@ -735,6 +3278,39 @@ def parse_cmdline(argv):
     parser.add_option('-L', '--hosts-list', dest='hosts', default=False,
                       metavar='HOSTS',
                       help='List of host:port to connect to tsd\'s (comma separated).')
+    parser.add_option('--in-process', dest='in_process', action='store_true',
+                      default=False,
+                      help='Run the Python collectors that define a collect() '
+                           'generator in threads instead of subprocesses.')
+    parser.add_option('--forkserver', dest='forkserver', action='store_true',
+                      default=False,
+                      help='Start the Python collectors of the interval '
+                           'directories by forking a process that already '
+                           'imported the common modules.')
+    parser.add_option('--schedule', dest='schedule', type='choice',
+                      choices=SCHEDULE_MODES, default='interval',
+                      help='When to run the interval collectors: every '
+                           'interval after their previous run (interval), '
+                           'on the multiples of their interval (aligned), or '
+                           'at an offset from those that depends on the host '
+                           '(jittered), to spread the load of a fleet. '
+                           'default=%default')
+    parser.add_option('--cgroup', dest='cgroup', metavar='PATH',
+                      help='Run each collector in its own cgroup (v2) under '
+                           'this one, like /sys/fs/cgroup/tcollector, which '
+                           'tcollector must be able to write to.')
+    parser.add_option('--cgroup-cpu', dest='cgroup_cpu', type='float',
+                      metavar='CPUS',
+                      help='How many CPUs each collector can use, with '
+                           '--cgroup (e.g. 0.5).')
+    parser.add_option('--cgroup-memory-max', dest='cgroup_memory_max',
+                      type='int', metavar='BYTES',
+                      help='How much memory each collector can use, with '
+                           '--cgroup.')
+    parser.add_option('--shard', dest='shard', action='store_true',
+                      default=False,
+                      help='Send to all the TSDs of --hosts-list at once, '
+                           'spreading the timeseries between them.')
     parser.add_option('--no-tcollector-stats', dest='no_tcollector_stats',
                       default=False, action='store_true',
                       help='Prevent tcollector from reporting its own stats to TSD')
@@ -760,11 +3336,62 @@ def parse_cmdline(argv):
                            'datapoints are suppressed before sending to the TSD. '
                            'Use zero to disable. '
                            'default=%default')
+    parser.add_option('--validation-mode', dest='validation', type='choice',
+                      choices=LineParser.MODES, default='lenient',
+                      metavar='MODE',
+                      help='How to validate the data points of the collectors: '
+                           '"lenient" accepts any value, "strict" requires '
+                           'numeric values and unique tag names. '
+                           'default=%default')
     parser.add_option('--evict-interval', dest='evictinterval', type='int',
                       default=6000, metavar='EVICTINTERVAL',
                       help='Number of seconds after which to remove cached '
                            'values of old data points to save memory. '
                            'default=%default')
+    parser.add_option('--max-send-latency', dest='max_send_latency',
+                      type='float', default=DEFAULT_MAX_SEND_LATENCY,
+                      metavar='SECONDS',
+                      help='Maximum number of seconds data points are held '
+                           'before being sent to the TSD. default=%default')
+    parser.add_option('--max-batch-bytes', dest='max_batch_bytes', type='int',
+                      default=DEFAULT_MAX_BATCH_BYTES, metavar='BYTES',
+                      help='Send data points to the TSD as soon as this many '
+                           'bytes are pending, and at most this many at once. '
+                           'default=%default')
+    parser.add_option('--http', dest='http', action='store_true',
+                      default=False,
+                      help='Send data points to the /api/put endpoint of the '
+                           'TSD\'s HTTP API instead of using "put" commands.')
+    parser.add_option('--http-batch-size', dest='http_batch_size', type='int',
+                      default=DEFAULT_HTTP_BATCH_SIZE, metavar='POINTS',
+                      help='Number of data points per HTTP request. '
+                           'default=%default')
+    parser.add_option('--http-gzip', dest='http_gzip', action='store_true',
+                      default=False,
+                      help='Compress the HTTP requests with gzip.')
+    parser.add_option('--spool-dir', dest='spool_dir', metavar='DIR',
+                      default=None,
+                      help='Directory where to spool the data points that '
+                           'can\'t be sent while no TSD is reachable. '
+                           'Spooling is disabled by default.')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=DEFAULT_SPOOL_MAX_BYTES, metavar='BYTES',
+                      help='Maximum disk space used by the spool, the oldest '
+                           'data is thrown away beyond that. default=%default')
+    parser.add_option('--spool-segment-bytes', dest='spool_segment_bytes',
+                      type='int', default=DEFAULT_SPOOL_SEGMENT_BYTES,
+                      metavar='BYTES',
+                      help='Size of each spool file. default=%default')
+    parser.add_option('--spool-fsync', dest='spool_fsync', type='choice',
+                      choices=DiskSpool.FSYNC_POLICIES, default='segment',
+                      metavar='POLICY',
+                      help='When to fsync the spool: "always", after each '
+                           '"segment", or "never". default=%default')
+    parser.add_option('--spool-replay-rate', dest='spool_replay_rate',
+                      type='int', default=DEFAULT_SPOOL_REPLAY_RATE,
+                      metavar='LINES',
+                      help='Maximum number of spooled lines per second to '
+                           'send once a TSD is reachable. default=%default')
     parser.add_option('--max-bytes', dest='max_bytes', type='int',
                       default=64 * 1024 * 1024,
                       help='Maximum bytes per a logfile.')
@@ -773,12 +3400,45 @@ def parse_cmdline(argv):
     parser.add_option('--logfile', dest='logfile', type='str',
                       default=DEFAULT_LOG,
                       help='Filename where logs are written to.')
+    parser.add_option('--stderr-rate', dest='stderr_rate', type='float',
+                      default=STDERR_RATE, metavar='LINES',
+                      help='Lines per second of stderr to log per collector, '
+                           'the others are counted and summarized. '
+                           'default=%default')
+    parser.add_option('--stderr-burst', dest='stderr_burst', type='int',
+                      default=STDERR_BURST, metavar='LINES',
+                      help='Lines of stderr a collector can log at once, '
+                           'above --stderr-rate. default=%default')
     parser.add_option('--reconnect-interval',dest='reconnectinterval', type='int',
                       default=0, metavar='RECONNECTINTERVAL',
                       help='Number of seconds after which the connection to'
                            'the TSD hostname reconnects itself. This is useful'
                            'when the hostname is a multiple A record (RRDNS).'
                            )
+    parser.add_option('--max-queue-bytes', dest='max_queue_bytes', type='int',
+                      default=DEFAULT_MAX_QUEUE_BYTES, metavar='BYTES',
+                      help='How much memory the data waiting to be sent to '
+                           'the TSD can use, roughly.  The sender uses up to '
+                           '%d bytes more for the data it\'s sending. '
+                           'default=%%default' % MAX_SENDQ_BYTES)
+    parser.add_option('--drop-policy', dest='drop_policy', type='choice',
+                      choices=DROP_POLICIES, default='priority',
+                      help='Which data to drop (or spool) when tcollector '
+                           'runs out of --max-queue-bytes: the newest, the '
+                           'oldest, or that of the collectors with the '
+                           'lowest priority (the newest for the same '
+                           'priority). default=%default')
+    parser.add_option('--priority', dest='priorities', action='append',
+                      default=[], metavar='COLLECTOR=PRIORITY',
+                      help='Priority of the data of a collector, higher is '
+                           'sent first and dropped last, e.g.: --priority '
+                           'procstats.py=2.  The others have priority 0. '
+                           'collectors/etc/config.py can change '
+                           'options.priorities too.')
+    parser.add_option('--dns-ttl', dest='dns_ttl', type='int',
+                      default=DEFAULT_DNS_TTL, metavar='SECONDS',
+                      help='How long to use the addresses of the TSDs before '
+                           'resolving them again. default=%default')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -787,6 +3447,44 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    priorities = {}
+    for priority in options.priorities:
+        name, _, level = priority.rpartition('=')
+        try:
+            level = int(level)
+        except ValueError:
+            name = None
+        if not name:
+            parser.error('--priority must be COLLECTOR=PRIORITY, got %r'
+                         % priority)
+        priorities[name] = level
+    options.priorities = priorities
+    if options.max_queue_bytes <= 0:
+        parser.error('--max-queue-bytes must be strictly positive')
+    if options.dns_ttl <= 0:
+        parser.error('--dns-ttl must be strictly positive')
+    if options.max_send_latency < 0:
+        parser.error('--max-send-latency must be at least 0 seconds')
+    if options.max_batch_bytes <= 0:
+        parser.error('--max-batch-bytes must be strictly positive')
+    if options.http_batch_size <= 0:
+        parser.error('--http-batch-size must be strictly positive')
+    if options.spool_segment_bytes <= 0:
+        parser.error('--spool-segment-bytes must be strictly positive')
+    if options.spool_max_bytes < options.spool_segment_bytes:
+        parser.error('--spool-max-bytes must be at least '
+                     '--spool-segment-bytes')
+    if options.spool_replay_rate <= 0:
+        parser.error('--spool-replay-rate must be strictly positive')
+    if options.stderr_rate <= 0:
+        parser.error('--stderr-rate must be strictly positive')
+    if options.stderr_burst < 1:
+        parser.error('--stderr-burst must be at least 1')
+    if options.cgroup_cpu is not None and options.cgroup_cpu <= 0:
+        parser.error('--cgroup-cpu must be strictly positive')
+    if (options.cgroup_memory_max is not None
+        and options.cgroup_memory_max <= 0):
+        parser.error('--cgroup-memory-max must be strictly positive')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -835,6 +3533,8 @@ def setup_python_path(collector_dir):
 def main(argv):
     """The main tcollector entry point and loop."""
 
+    global POLLER, IN_PROCESS, FORKSERVER, SCHEDULE_MODE, CGROUPS
+    global STDERR_RATE, STDERR_BURST
     options, args = parse_cmdline(argv)
     if options.daemonize:
         daemonize()
@@ -866,17 +3566,52 @@ def main(argv):
         LOG.fatal('No such directory: %s', options.cdir)
         return 1
     modules = load_etc_dir(options, tags)
+    set_priorities(options.priorities)
 
     setup_python_path(options.cdir)
 
+    # this has to fork before we start any thread.
+    if options.forkserver and not options.stdin:
+        FORKSERVER = ForkServer()
+        FORKSERVER.start()
+    # the forkserver logs synchronously, we write from a thread from now on.
+    setup_async_logging()
+
     # gracefully handle death for normal termination paths and abnormal
     atexit.register(shutdown)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
 
+    # wait for output from our children with epoll when we can, in stdin
+    # mode the StdinCollector does blocking reads anyway.
+    if not options.stdin and hasattr(select, 'epoll'):
+        POLLER = ReaderPoller()
+    if not options.stdin:
+        setup_wakeup_pipe()
+    IN_PROCESS = options.in_process
+    if options.cgroup:
+        try:
+            CGROUPS = CgroupManager(options.cgroup, options.cgroup_cpu,
+                                    options.cgroup_memory_max)
+        except (IOError, OSError), e:
+            LOG.fatal('Failed to set up the cgroup %s: %s', options.cgroup, e)
+            return 1
+    SCHEDULE_MODE = options.schedule
+    STDERR_RATE = options.stderr_rate
+    STDERR_BURST = options.stderr_burst
+
     # at this point we're ready to start processing, so start the ReaderThread
     # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval)
+    reader = ReaderThread(options.dedupinterval, options.evictinterval,
+                          options.validation, tags)
+    reader.readerq.max_bytes = options.max_queue_bytes
+    reader.readerq.drop_policy = options.drop_policy
+    if options.spool_dir:
+        spool = DiskSpool(options.spool_dir, options.spool_max_bytes,
+                          options.spool_segment_bytes, options.spool_fsync)
+        reader.readerq.spool = spool
+    else:
+        spool = None
     reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
@@ -897,9 +3632,20 @@ def main(argv):
         if options.host != "localhost" or options.port != DEFAULT_PORT:
             options.hosts.append((options.host, options.port))
 
+    resolver = Resolver(options.dns_ttl)
+    resolver.start()
+
     # and setup the sender to start writing out to the tsd
-    sender = SenderThread(reader, options.dryrun, options.hosts,
-                          not options.no_tcollector_stats, tags, options.reconnectinterval)
+    if options.shard and len(options.hosts) > 1:
+        sender_class = ShardedSender
+    else:
+        sender_class = SenderThread
+    sender = sender_class(reader, options.dryrun, options.hosts,
+                          not options.no_tcollector_stats, tags,
+                          options.reconnectinterval, options.max_send_latency,
+                          options.max_batch_bytes, options.http,
+                          options.http_batch_size, options.http_gzip,
+                          spool, options.spool_replay_rate, resolver)
     sender.start()
     LOG.info('SenderThread startup complete')
 
@@ -938,13 +3684,35 @@ def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
     next_heartbeat = int(time.time() + 600)
+    next_scan = 0
+    watcher = DirectoryWatcher.create(options.cdir)
+    if watcher is None:
+        scan_interval = SCAN_INTERVAL
+        extra_fds = ()
+    else:
+        scan_interval = FULL_SCAN_INTERVAL
+        extra_fds = (watcher.fileno(),)
+    collectors_changed = etc_changed = False
     while ALIVE:
-        populate_collectors(options.cdir)
-        reload_changed_config_modules(modules, options, sender, tags)
+        now = time.time()
+        if now >= next_scan:
+            collectors_changed = etc_changed = True
+            next_scan = now + scan_interval
+        if collectors_changed:
+            populate_collectors(options.cdir)
+        if etc_changed:
+            reload_changed_config_modules(modules, options, sender, tags)
         reap_children()
         check_children()
         spawn_children()
-        time.sleep(15)
+        # sleep until a collector exits or has to be (re)started or killed,
+        # or until something changes in the collector directories.
+        timeout = min(next_scan, next_spawn_time(), now + SCAN_INTERVAL)
+        ready = wait_for_children(timeout - time.time(), extra_fds)
+        if ready:
+            collectors_changed, etc_changed = watcher.read()
+        else:
+            collectors_changed = etc_changed = False
         now = int(time.time())
         if now >= next_heartbeat:
             LOG.info('Heartbeat (%d collectors running)'
@@ -952,6 +3720,93 @@ def main_loop(options, modules, sender, tags):
             next_heartbeat = now + 600
 
 
+def setup_wakeup_pipe():
+    """Makes SIGCHLD, and the in-process collectors that exit, wake up the
+       main loop through a pipe."""
+    global WAKEUP_PIPE
+    WAKEUP_PIPE = os.pipe()
+    for fd in WAKEUP_PIPE:
+        set_nonblocking(fd)
+    signal.set_wakeup_fd(WAKEUP_PIPE[1])
+    # the handler does nothing, the signal module writes to the pipe.
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # don't let SIGCHLD interrupt the system calls of the other threads.
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+
+def wakeup_main_loop():
+    """Wakes up the main loop if it's waiting for the collectors."""
+    if WAKEUP_PIPE is None:
+        return
+    try:
+        os.write(WAKEUP_PIPE[1], '\0')
+    except OSError:
+        pass  # The pipe is full, the main loop will wake up anyway.
+
+
+def wait_for_children(timeout, extra_fds=()):
+    """Sleeps at most timeout seconds, or until a collector exits, or until
+       one of the extra file descriptors is readable.
+
+    Returns: The list of the extra file descriptors that are readable.
+    """
+    fds = list(extra_fds)
+    if WAKEUP_PIPE is not None:
+        fds.append(WAKEUP_PIPE[0])
+    if FORKSERVER is not None:
+        fds.append(FORKSERVER.sock)
+    if not fds:
+        time.sleep(max(timeout, 0))
+        return []
+    try:
+        ready = select.select(fds, [], [], max(timeout, 0))[0]
+    except select.error, (err, msg):
+        if err != errno.EINTR:
+            raise
+        return []
+    if WAKEUP_PIPE is not None and WAKEUP_PIPE[0] in ready:
+        try:
+            os.read(WAKEUP_PIPE[0], 4096)
+        except OSError:
+            pass
+    if FORKSERVER is not None and FORKSERVER.sock in ready:
+        try:
+            with FORKSERVER.lock:
+                FORKSERVER.drain()
+        except socket.error, e:
+            forkserver_died(e)
+    return [fd for fd in ready if fd in extra_fds]
+
+
+def forkserver_died(error):
+    """Stops using the ForkServer after it died: the collectors run as
+       subprocesses from now on."""
+    global FORKSERVER
+    if FORKSERVER is None:
+        return
+    LOG.error('the forkserver died (%s), running the collectors as'
+              ' subprocesses from now on', error)
+    FORKSERVER.abandon()
+    FORKSERVER = None
+
+
+def next_spawn_time():
+    """Returns when spawn_children has something to do next."""
+    next_time = []
+    for col in all_collectors():
+        if col.dead and not col.interval:
+            # all_valid_collectors gives it another chance after an hour.
+            next_time.append(col.lastspawn + 3601)
+        elif col.interval == 0 and col.proc is None:
+            next_time.append(col.lastspawn + MIN_RESPAWN_INTERVAL)
+        elif col.exit_time is not None:
+            # reap_children is waiting for the ReaderThread.
+            next_time.append(col.exit_time + PIPE_DRAIN_TIMEOUT)
+    if SCHEDULE:
+        next_time.append(SCHEDULE[0][0])
+    return min(next_time or [time.time() + SCAN_INTERVAL])
+
+
 def list_config_modules(etcdir):
     """Returns an iterator that yields the name of all the config modules."""
     if not os.path.isdir(etcdir):
@@ -1045,9 +3900,22 @@ def reload_changed_config_modules(modules, options, sender, tags):
             modules[path] = (module, os.path.getmtime(path))
             changed = True
 
+    if changed:
+        set_priorities(options.priorities)
     return changed
 
 
+def set_priorities(priorities):
+    """Sets the priority of the collectors from a dict that maps their
+       names to their priority, the others get 0."""
+    global PRIORITIES
+    if priorities != PRIORITIES:
+        LOG.info('Collector priorities: %s', priorities)
+    PRIORITIES = dict(priorities)
+    for col in all_collectors():
+        col.priority = PRIORITIES.get(col.name, 0)
+
+
 def write_pid(pidfile):
     """Write our pid to a pidfile."""
     f = open(pidfile, "w")
@@ -1092,6 +3960,9 @@ def shutdown_signal(signum, frame):
 
 
 def kill(proc, signum=signal.SIGTERM):
+  if isinstance(proc, ThreadProc):
+    proc.send_signal(signum)
+    return
   os.killpg(proc.pid, signum)
 
 
@@ -1105,12 +3976,16 @@ def shutdown():
         return
     # notify threads of program termination
     ALIVE = False
+    if POLLER is not None:
+        POLLER.wakeup()
 
     LOG.info('shutting down children')
 
     # tell everyone to die
     for col in all_living_collectors():
         col.shutdown()
+    if FORKSERVER is not None:
+        FORKSERVER.stop()
 
     LOG.info('exiting')
     sys.exit(1)
@@ -1122,13 +3997,30 @@ def reap_children():
 
     for col in all_living_collectors():
         now = int(time.time())
+        # read the usage of the process before it's reaped.
+        col.usage.sample()
         # FIXME: this is not robust.  the asyncproc module joins on the
         # reader threads when you wait if that process has died.  this can cause
         # slow dying processes to hold up the main loop.  good for now though.
-        status = col.proc.poll()
+        try:
+            status = col.proc.poll()
+        except socket.error, e:
+            forkserver_died(e)  # Which marks the collector as exited.
+            status = col.proc.poll()
         if status is None:
             continue
+        # let the ReaderThread read everything the collector wrote before
+        # it exited, that is until it gets EOF on its pipes.
+        if col.exit_time is None:
+            col.exit_time = time.time()
+        if (POLLER is not None and POLLER.watching(col)
+            and time.time() < col.exit_time + PIPE_DRAIN_TIMEOUT):
+            continue
+        if POLLER is not None:
+            POLLER.unregister(col)
+        col.usage.finish(getattr(col.proc, 'usage', None))
         col.proc = None
+        col.exit_time = None
 
         # behavior based on status.  a code 0 is normal termination, code 13
         # is used to indicate that we don't want to restart this collector.
@@ -1173,23 +4065,55 @@ def spawn_collector(col):
 
     LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
 
-    # FIXME: do custom integration of Python scripts into memory/threads
-    # if re.search('\.py$', col.name) is not None:
-    #     ... load the py module directly instead of using a subprocess ...
+    in_process = IN_PROCESS and ThreadProc.supports(col.filename)
+    cgroup = None
+    if CGROUPS is not None and not in_process:  # Threads can't have one.
+        cgroup = CGROUPS.setup(col)
+
+    def preexec():
+        if cgroup is not None:
+            CgroupManager.join(cgroup)
+        os.setsid()
+
     try:
-        col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    close_fds=True,
-                                    preexec_fn=os.setsid)
+        if in_process:
+            if ThreadProc.still_running(col):
+                if col.name not in ThreadProc.stuck:
+                    LOG.warning('the thread of the previous run of %s is'
+                                ' still running, not starting it again',
+                                col.name)
+                    ThreadProc.stuck.add(col.name)
+                col.lastspawn = int(time.time())
+                return
+            col.proc = ThreadProc(col)
+        elif (FORKSERVER is not None and col.interval
+              and col.filename.endswith('.py')):
+            try:
+                col.proc = FORKSERVER.spawn(col, cgroup)
+            except socket.error, e:
+                forkserver_died(e)
+            except OSError, e:
+                LOG.error('Failed to spawn %s with the forkserver, running'
+                          ' it as a subprocess: %s', col.name, e)
+        if col.proc is None:
+            col.proc = subprocess.Popen(col.filename, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=preexec)
     except OSError, e:
         LOG.error('Failed to spawn collector %s: %s' % (col.filename, e))
+        # wait MIN_RESPAWN_INTERVAL before trying again, like when it exits.
+        col.lastspawn = int(time.time())
         return
     # The following line needs to move below this line because it is used in
     # other logic and it makes no sense to update the last spawn time if the
     # collector didn't actually start.
     col.lastspawn = int(time.time())
+    col.usage.start(col.proc)
     set_nonblocking(col.proc.stdout.fileno())
     set_nonblocking(col.proc.stderr.fileno())
+    if POLLER is not None:
+        POLLER.register(col)
     if col.proc.pid > 0:
         col.dead = False
         LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
@@ -1209,38 +4133,91 @@ def spawn_children():
     for col in all_valid_collectors():
         now = int(time.time())
         if col.interval == 0:
-            if col.proc is None:
-                spawn_collector(col)
-        elif col.interval <= now - col.lastspawn:
-            if col.proc is None:
+            if (col.proc is None
+                and now - col.lastspawn >= MIN_RESPAWN_INTERVAL):
                 spawn_collector(col)
-                continue
 
-            # I'm not very satisfied with this path.  It seems fragile and
-            # overly complex, maybe we should just reply on the asyncproc
-            # terminate method, but that would make the main tcollector
-            # block until it dies... :|
-            if col.nextkill > now:
-                continue
-            if col.killstate == 0:
-                LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
-                            'its welcome, SIGTERM sent',
-                            col.name, col.interval, col.proc.pid)
-                kill(col.proc)
-                col.nextkill = now + 5
-                col.killstate = 1
-            elif col.killstate == 1:
-                LOG.error('error: %s (interval=%d, pid=%d) still not dead, '
-                           'SIGKILL sent',
-                           col.name, col.interval, col.proc.pid)
-                kill(col.proc, signal.SIGKILL)
-                col.nextkill = now + 5
-                col.killstate = 2
-            else:
-                LOG.error('error: %s (interval=%d, pid=%d) needs manual '
-                           'intervention to kill it',
-                           col.name, col.interval, col.proc.pid)
-                col.nextkill = now + 300
+    # the interval collectors run when they're due in the SCHEDULE.
+    while SCHEDULE and SCHEDULE[0][0] <= time.time():
+        when, name = heapq.heappop(SCHEDULE)
+        col = COLLECTORS.get(name)
+        if col is None or col.next_run != when:
+            continue  # removed or rescheduled since.
+        now = int(time.time())
+        if col.dead and now - col.lastspawn <= 3600:
+            # all_valid_collectors gives it another chance after an hour.
+            schedule_collector(col, col.lastspawn + 3601)
+            continue
+        if col.proc is None:
+            col.schedule_lag = time.time() - when
+            SCHEDULE_LAG.add(col.schedule_lag * 1000)
+            spawn_collector(col)
+            schedule_collector(col, next_run_time(col, when))
+            continue
+
+        # I'm not very satisfied with this path.  It seems fragile and
+        # overly complex, maybe we should just reply on the asyncproc
+        # terminate method, but that would make the main tcollector
+        # block until it dies... :|
+        if col.killstate == 0:
+            LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
+                        'its welcome, SIGTERM sent',
+                        col.name, col.interval, col.proc.pid)
+            kill(col.proc)
+            col.nextkill = now + 5
+            col.killstate = 1
+        elif col.killstate == 1:
+            LOG.error('error: %s (interval=%d, pid=%d) still not dead, '
+                       'SIGKILL sent',
+                       col.name, col.interval, col.proc.pid)
+            kill(col.proc, signal.SIGKILL)
+            col.nextkill = now + 5
+            col.killstate = 2
+        else:
+            LOG.error('error: %s (interval=%d, pid=%d) needs manual '
+                       'intervention to kill it',
+                       col.name, col.interval, col.proc.pid)
+            col.nextkill = now + 300
+        # run it as soon as it's gone, if it's not been marked dead.
+        schedule_collector(col, col.nextkill)
+
+
+def schedule_offset(col):
+    """Returns how many seconds after the interval boundaries a collector
+       runs in 'jittered' mode.  That's derived from a hash of the name of
+       the host and the collector, so that it's different on every host but
+       doesn't change when tcollector restarts."""
+    digest = hashlib.md5(socket.gethostname() + ' ' + col.name).hexdigest()
+    return int(digest[:8], 16) % (col.interval * 1000) / 1000.0
+
+
+def first_run_time(col):
+    """Returns when a new interval collector runs for the first time."""
+    now = time.time()
+    if SCHEDULE_MODE == 'interval':
+        return max(col.lastspawn + col.interval, now)
+    return next_run_time(col, now)
+
+
+def next_run_time(col, last_run):
+    """Returns when an interval collector runs next, after last_run."""
+    now = time.time()
+    if SCHEDULE_MODE == 'interval':
+        # don't drift, unless we're more than an interval late.
+        return max(last_run + col.interval, now)
+    offset = 0
+    if SCHEDULE_MODE == 'jittered':
+        offset = schedule_offset(col)
+    # the first interval boundary (plus offset) after last_run and now.
+    periods = math.floor((max(last_run, now) - offset) / col.interval) + 1
+    return periods * col.interval + offset
+
+
+def schedule_collector(col, when):
+    """Makes the given interval collector run (or get killed if it's still
+       running) at the given time."""
+    col.next_run = when
+    heapq.heappush(SCHEDULE, (when, col.name))
 
 
 def populate_collectors(coldir):
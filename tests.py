@@ -12,8 +12,18 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import httplib
+import json
+import logging
 import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
+import zlib
 from stat import S_ISDIR, S_ISREG, ST_MODE
 import unittest
 
@@ -104,6 +114,1249 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+    def test_preferHealthiestConnection(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        sender = self.mkSenderThread([tsd1, tsd2])
+        sender.health[tsd1].connected(0.5)
+        sender.health[tsd2].connected(0.01)
+        for i in xrange(3):
+            sender.pick_connection()
+            self.assertEqual(tsd2, (sender.host, sender.port))
+
+    def test_halfOpenProbe(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        sender = self.mkSenderThread([tsd1, tsd2])
+        sender.pick_connection()
+        sender.blacklist_connection()
+        health = sender.health[tsd1]
+        self.assertEqual(tcollector.TSDHealth.OPEN, health.state)
+        self.assertEqual(0, sender.reconnect_delay())  # tsd2 is fine.
+        # Once the circuit is half-open, tsd1 gets probed again, and one
+        # success is enough to close it.
+        health.retry_time = 0
+        # looking at the candidates doesn't change the state of the TSDs.
+        self.assertEqual(0, sender.reconnect_delay())
+        self.assertEqual(tcollector.TSDHealth.OPEN, health.state)
+        sender.pick_connection()
+        self.assertEqual(tsd2, (sender.host, sender.port))
+        self.assertEqual(tcollector.TSDHealth.OPEN, health.state)
+        sender.blacklist_connection()
+        sender.health[tsd2].retry_time = time.time() + 60
+        sender.pick_connection()
+        self.assertEqual(tsd1, (sender.host, sender.port))
+        self.assertEqual(tcollector.TSDHealth.HALF_OPEN, health.state)
+        sender.connection_ok()
+        self.assertEqual(tcollector.TSDHealth.CLOSED, health.state)
+        self.assertEqual(0, health.failures)
+
+    def test_backoffIsCapped(self):
+        health = tcollector.TSDHealth()
+        for i in xrange(100):
+            health.failure()
+        self.assertTrue(health.retry_time - time.time()
+                        <= tcollector.TSDHealth.MAX_OPEN_TIME)
+        self.assertFalse(health.available())
+
+
+class ResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = tcollector.Resolver(ttl=60)
+        self.lookups = []
+        self.addresses = [(2, 1, 6, '', ('10.0.0.1', 4242)),
+                          (2, 1, 6, '', ('10.0.0.2', 4242))]
+        self.resolver.getaddrinfo = self.getaddrinfo
+
+    def getaddrinfo(self, host, port):
+        self.lookups.append((host, port))
+        if self.addresses is None:
+            raise tcollector.socket.gaierror(tcollector.socket.EAI_AGAIN,
+                                             'try again')
+        return self.addresses
+
+    def test_cacheAndRoundRobin(self):
+        first = self.resolver.resolve('tsd', 4242)
+        second = self.resolver.resolve('tsd', 4242)
+        self.assertEqual(self.addresses, first)
+        self.assertEqual(self.addresses[::-1], second)
+        self.assertEqual([('tsd', 4242)], self.lookups)
+
+    def test_keepStaleAddresses(self):
+        self.resolver.resolve('tsd', 4242)
+        self.resolver.cache[('tsd', 4242)][0] = 0  # Expire the entry.
+        self.addresses = None
+        self.assertEqual(2, len(self.resolver.resolve('tsd', 4242)))
+        self.assertEqual(2, len(self.lookups))
+        self.assertRaises(tcollector.socket.gaierror,
+                          self.resolver.resolve, 'other', 4242)
+
+
+class StubTSDHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accepts everything POSTed on /api/put except for bad.metric."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        points = json.loads(body)
+        self.server.requests.append(self.path)
+        self.server.points.extend(points)
+        errors = [{'datapoint': p, 'error': 'Unknown metric'}
+                  for p in points if p['metric'] == 'bad.metric']
+        if errors:
+            payload = json.dumps({'success': len(points) - len(errors),
+                                  'failed': len(errors), 'errors': errors})
+            self.send_response(400)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_response(204)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                StubTSDHandler)
+        self.server.requests = []
+        self.server.points = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def mkSenderThread(self, **kwargs):
+        port = self.server.server_address[1]
+        sender = tcollector.SenderThread(None, False, [('127.0.0.1', port)],
+                                         False, {'host': 'test'}, 0,
+                                         http=True, **kwargs)
+        sender.host, sender.port = '127.0.0.1', port
+        sender.tsd = httplib.HTTPConnection(sender.host, sender.port)
+        return sender
+
+    def test_sendBatches(self):
+        sender = self.mkSenderThread(http_batch_size=2, http_gzip=True)
+        sender.sendq = ['foo.bar 1400000000 42 a=1',
+                        'foo.bar 1400000000 4.2 host=other',
+                        'foo.baz 1400000000 1']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual(['/api/put?details'] * 2, self.server.requests)
+        self.assertEqual([
+            {'metric': 'foo.bar', 'timestamp': 1400000000, 'value': 42,
+             'tags': {'a': '1', 'host': 'test'}},
+            {'metric': 'foo.bar', 'timestamp': 1400000000, 'value': 4.2,
+             'tags': {'host': 'other'}},
+            {'metric': 'foo.baz', 'timestamp': 1400000000, 'value': 1,
+             'tags': {'host': 'test'}}], self.server.points)
+        self.assertEqual(3, sender.points_sent)
+
+    def test_resolveWithResolver(self):
+        lookups = []
+
+        def getaddrinfo(host, port):
+            lookups.append((host, port))
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     ('127.0.0.1', port))]
+
+        sender = self.mkSenderThread()
+        sender.resolver.getaddrinfo = getaddrinfo
+        sender.host = 'tsd.invalid'
+        sender.tsd = None
+        sender.pick_connection = lambda: None
+        sender.verify_http_conn = lambda: True
+        sender.report_self_stats = lambda: None
+        sender.maintain_conn()
+        sender.sendq = ['foo.bar 1400000000 42']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual(1, sender.points_sent)
+        self.assertEqual([('tsd.invalid', sender.port)], lookups)
+
+    def test_countRejectedPoints(self):
+        sender = self.mkSenderThread()
+        sender.sendq = ['foo.bar 1400000000 42', 'bad.metric 1400000000 42']
+        sender.send_data()
+        self.assertEqual([], sender.sendq)
+        self.assertEqual(1, sender.points_sent)
+        self.assertEqual(1, sender.points_rejected)
+        self.assertEqual({'bad.metric': 1}, sender.rejected_metrics)
+
+
+class TelnetSenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sender = tcollector.SenderThread(None, False, [('tsd', 4242)],
+                                              False, {}, 0)
+        self.sender.host, self.sender.port = 'tsd', 4242
+        self.sender.tsd, self.peer = socket.socketpair()
+
+    def tearDown(self):
+        self.peer.close()
+
+    def test_drainErrors(self):
+        self.peer.sendall("put: unknown metric: No such name for 'metrics':"
+                          " 'foo.bar'\nput: invalid value: x\nput: unkn")
+        self.sender.sendq = ['foo.bar 1400000000 1', 'foo.baz 1400000000 x']
+        self.sender.send_data()
+        self.assertEqual([], self.sender.sendq)
+        self.assertEqual(2, self.sender.points_rejected)
+        self.assertEqual({'foo.bar': 1, 'unknown': 1},
+                         self.sender.rejected_metrics)
+        self.assertEqual('put: unkn', self.sender.responses)
+        self.assertTrue(self.sender.tsd is not None)
+
+    def test_resendUnsentTail(self):
+        class BrokenSocket(object):
+            """Takes 30 bytes at most 8 at a time, then breaks."""
+            data = ''
+            def send(self, data):
+                if len(self.data) >= 30:
+                    raise socket.error(32, 'Broken pipe')
+                self.data += str(data)[:8]
+                return min(8, len(data))
+            def close(self):
+                pass
+        self.sender.tsd = tsd = BrokenSocket()
+        self.sender.sendq = ['foo.bar 1400000000 %d' % i for i in range(5)]
+        self.sender.send_data()
+        self.assertEqual(32, len(tsd.data))
+        self.assertEqual(['foo.bar 1400000000 %d' % i for i in range(1, 5)],
+                         self.sender.sendq)
+        self.assertEqual(1, self.sender.lines_sent)
+        self.assertTrue(self.sender.tsd is None)
+
+    def test_sendInChunks(self):
+        self.sender.sendq = ['foo.bar 1400000000 %d' % i
+                             for i in range(10000)]
+        received = []
+        reader = threading.Thread(target=self.drain, args=(received,))
+        reader.start()
+        self.sender.send_data()
+        self.sender.tsd.close()
+        reader.join()
+        self.assertEqual([], self.sender.sendq)
+        self.assertEqual(10000, self.sender.lines_sent)
+        self.assertEqual(''.join('put foo.bar 1400000000 %d\n' % i
+                                 for i in range(10000)), ''.join(received))
+
+    def drain(self, received):
+        while True:
+            data = self.peer.recv(65536)
+            if not data:
+                return
+            received.append(data)
+
+    def test_drainRetriesOnEINTR(self):
+        select = tcollector.select.select
+        calls = []
+        def interrupted(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise tcollector.select.error(tcollector.errno.EINTR,
+                                              'Interrupted system call')
+            return select(*args)
+        tcollector.select.select = interrupted
+        try:
+            self.assertTrue(self.sender.drain_responses())
+        finally:
+            tcollector.select.select = select
+        self.assertEqual(2, len(calls))
+        self.assertTrue(self.sender.tsd is not None)
+        self.assertEqual(tcollector.TSDHealth.CLOSED,
+                         self.sender.health[('tsd', 4242)].state)
+
+    def test_verifyClosedConnection(self):
+        self.assertTrue(self.sender.verify_conn())
+        self.sender.last_verify = 0
+        self.peer.close()
+        self.assertFalse(self.sender.verify_conn())
+        self.assertTrue(self.sender.tsd is None)
+
+
+class LineParserTests(unittest.TestCase):
+
+    def test_parseLine(self):
+        parser = tcollector.LineParser()
+        self.assertEqual(('foo.bar', 1400000000, '42', ''),
+                         parser.parse('foo.bar 1400000000 42'))
+        self.assertEqual(('foo.bar', 1400000000, '4.2', ' a=1 b=2'),
+                         parser.parse('foo.bar  1400000000 4.2 b=2\ta=1'))
+
+    def test_internTags(self):
+        parser = tcollector.LineParser()
+        first = parser.parse(''.join(['foo.bar 1400000000 1', ' a=1']))
+        second = tcollector.LineParser().parse(''.join(['foo.bar 1400000000 2',
+                                                        ' a=1']))
+        self.assertTrue(first[3] is second[3])
+
+    def test_parseInvalidLine(self):
+        parser = tcollector.LineParser()
+        for line in ('foo.bar 1400000000', 'foo.bar x 42', 'foo:bar 1 42',
+                     'foo.bar 1400000000 42 a', 'foo.bar 1400000000 42 a=1=2'):
+            self.assertEqual(None, parser.parse(line), line)
+
+    def test_strictMode(self):
+        lenient = tcollector.LineParser('lenient')
+        strict = tcollector.LineParser('strict')
+        for line in ('foo.bar 1400000000 NaN', 'foo.bar 1400000000 1 a=1 a=2'):
+            self.assertNotEqual(None, lenient.parse(line))
+            self.assertEqual(None, strict.parse(line), line)
+        self.assertEqual(('foo.bar', 1400000000, '-1.5e3', ' a=1'),
+                         strict.parse('foo.bar 1400000000 -1.5e3 a=1'))
+
+
+class ReaderThreadTestCase(unittest.TestCase):
+    """Base class for the tests of what self.reader, a ReaderThread, queues
+       for the sender."""
+
+    def sent(self):
+        self.reader.flush()
+        lines = []
+        for batch in self.reader.readerq.get_batches(100):
+            lines.extend(batch)
+        return lines
+
+
+class DedupTests(ReaderThreadTestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 6000)
+        self.col = tcollector.Collector('test', 0, 'test')
+
+    def test_suppressRepeatedValues(self):
+        for ts in (1400000000, 1400000015, 1400000030):
+            self.reader.process_line(self.col, 'foo.bar %d 1 b=2 a=1' % ts)
+        self.reader.process_line(self.col, 'foo.bar 1400000045 2 b=2 a=1')
+        self.assertEqual(['foo.bar 1400000000 1 b=2 a=1',
+                          'foo.bar 1400000030 1 a=1 b=2',
+                          'foo.bar 1400000045 2 b=2 a=1'], self.sent())
+
+    def test_internNewKeys(self):
+        first = tcollector.DedupStore()
+        second = tcollector.DedupStore()
+        first.set((''.join(['foo', '.bar']), ' a=1'), '1', 1400000000)
+        second.set((''.join(['foo', '.bar']), ' a=1'), '1', 1400000000)
+        self.assertTrue(first.entries.keys()[0][0]
+                        is second.entries.keys()[0][0])
+
+    def test_evictOldKeys(self):
+        store = tcollector.DedupStore()
+        for i in xrange(10):
+            store.set(('foo.bar', ' i=%d' % i), '1', 1400000000 + i * 30)
+        store.set(('foo.bar', ' i=0'), '2', 1400000300)
+        store.evict(1400000150)
+        self.assertEqual(6, len(store))
+        self.assertTrue(('foo.bar', ' i=0') in store)
+        self.assertFalse(('foo.bar', ' i=4') in store)
+        self.assertTrue(('foo.bar', ' i=5') in store)
+        store.evict(1400001000)
+        self.assertEqual(0, len(store))
+        self.assertEqual({}, store.wheel)
+
+
+class GlobalTagsTests(ReaderThreadTestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 6000,
+                                              tags={'host': 'a', 'dc': 'b'})
+        self.col = tcollector.Collector('test', 0, 'test')
+
+    def test_addTagsToLines(self):
+        self.reader.process_line(self.col, 'foo.bar 1400000000 1')
+        self.reader.process_line(self.col, 'foo.bar 1400000000 1 host=c x=1')
+        self.assertEqual(['foo.bar 1400000000 1 dc=b host=a',
+                          'foo.bar 1400000000 1 host=c x=1 dc=b'], self.sent())
+
+    def test_tagLine(self):
+        tags = self.reader.tags
+        self.assertEqual('tcollector.x 1 2 collector=y dc=b host=a',
+                         tags.tag_line('tcollector.x 1 2 collector=y'))
+        self.assertEqual('tcollector.x 1 2 host=z dc=b',
+                         tags.tag_line('tcollector.x 1 2 host=z '))
+
+
+class ReaderQueueTests(unittest.TestCase):
+
+    def test_dropWhenFull(self):
+        readerq = tcollector.ReaderQueue(5)
+        self.assertEqual(3, readerq.nput_batch(['a', 'b', 'c']))
+        self.assertEqual(2, readerq.nput_batch(['d', 'e', 'f']))
+        self.assertFalse(readerq.nput('g'))
+        self.assertEqual(5, readerq.qsize())
+
+    def test_maxBytes(self):
+        overhead = tcollector.QUEUED_LINE_OVERHEAD
+        readerq = tcollector.ReaderQueue(100, 3 * (overhead + 2))
+        self.assertEqual(2, readerq.nput_batch(['aa', 'bb']))
+        self.assertEqual(1, readerq.nput_batch(['cc', 'dd']))
+        self.assertEqual(3 * (overhead + 2), readerq.memory())
+        self.assertEqual(0, readerq.lines_evicted)
+
+    def test_dropOldest(self):
+        readerq = tcollector.ReaderQueue(4, drop_policy='oldest')
+        readerq.nput_batch(['a', 'b', 'c'])
+        self.assertEqual(2, readerq.nput_batch(['d', 'e']))
+        self.assertEqual(1, readerq.lines_evicted)
+        self.assertEqual([['b', 'c'], ['d', 'e']], readerq.get_batches(10))
+
+    def test_dropLowestPriority(self):
+        readerq = tcollector.ReaderQueue(4, drop_policy='priority')
+        readerq.nput_batch(['a', 'b'], priority=1)
+        readerq.nput_batch(['c', 'd'], priority=0)
+        self.assertEqual(2, readerq.nput_batch(['e', 'f'], priority=1))
+        self.assertEqual(0, readerq.nput_batch(['g'], priority=0))
+        self.assertEqual(1, readerq.nput_batch(['h'], priority=2))
+        self.assertEqual([['h'], ['b'], ['e', 'f']], readerq.get_batches(10))
+
+    def test_highestPriorityFirst(self):
+        readerq = tcollector.ReaderQueue(10)
+        readerq.nput_batch(['a', 'b'])
+        readerq.nput_batch(['c', 'd'], priority=2)
+        readerq.nput_batch(['e'], priority=1)
+        readerq.nput_batch(['f'], priority=2)
+        self.assertEqual([['c', 'd'], ['f'], ['e']], readerq.get_batches(4))
+        self.assertEqual([['a', 'b']], readerq.get_batches(4))
+
+    def test_setPriorities(self):
+        saved = tcollector.COLLECTORS.copy(), tcollector.PRIORITIES
+        try:
+            col = tcollector.Collector('procstats.py', 0, 'procstats.py')
+            tcollector.COLLECTORS['procstats.py'] = col
+            tcollector.set_priorities({'procstats.py': 2})
+            self.assertEqual(2, col.priority)
+            self.assertEqual(2, tcollector.Collector('procstats.py', 0,
+                                                     'procstats.py').priority)
+            self.assertEqual(0, tcollector.Collector('mysql.py', 0,
+                                                     'mysql.py').priority)
+            tcollector.set_priorities({})
+            self.assertEqual(0, col.priority)
+        finally:
+            tcollector.COLLECTORS.clear()
+            tcollector.COLLECTORS.update(saved[0])
+            tcollector.PRIORITIES = saved[1]
+
+    def test_getBatches(self):
+        readerq = tcollector.ReaderQueue(10)
+        readerq.nput_batch(['a', 'b', 'c'])
+        readerq.nput_batch(['d', 'e'])
+        self.assertEqual([['a', 'b', 'c'], ['d']], readerq.get_batches(4))
+        self.assertTrue(readerq.wait(0))
+        self.assertEqual([['e']], readerq.get_batches(4))
+        # the batch that was split is only counted once.
+        self.assertEqual(2, readerq.queue_time.count)
+        self.assertFalse(readerq.wait(0))
+        self.assertEqual([], readerq.get_batches(4))
+
+    def test_getBatchesMaxBytes(self):
+        readerq = tcollector.ReaderQueue(10)
+        readerq.nput_batch(['aa', 'bb', 'cc'])
+        readerq.nput_batch(['dddddd'])
+        self.assertEqual([['aa', 'bb']], readerq.get_batches(10, 5))
+        self.assertEqual(8, readerq.bytes)
+        # We always make progress, even with lines bigger than max_bytes.
+        self.assertEqual([['cc']], readerq.get_batches(10, 5))
+        self.assertEqual([['dddddd']], readerq.get_batches(10, 5))
+        self.assertEqual(0, readerq.bytes)
+        self.assertEqual(2, readerq.queue_time.count)
+
+    def test_waitForBytes(self):
+        readerq = tcollector.ReaderQueue(10)
+        readerq.nput('aa')
+        start = time.time()
+        self.assertTrue(readerq.wait(0.1, 3))
+        self.assertTrue(time.time() - start >= 0.1)
+        readerq.nput('bb')
+        start = time.time()
+        self.assertTrue(readerq.wait(10, 3))
+        self.assertTrue(time.time() - start < 1)
+
+
+class DiskSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_appendAndRead(self):
+        spool = tcollector.DiskSpool(self.directory, 1000, 20)
+        self.assertFalse(spool.pending())
+        for i in xrange(5):
+            self.assertTrue(spool.append(['foo.bar %d 1' % i]))
+        self.assertEqual(3, len(os.listdir(self.directory)))
+        self.assertTrue(spool.pending())
+        self.assertEqual(['foo.bar 0 1', 'foo.bar 1 1', 'foo.bar 2 1'],
+                         spool.read(3))
+        self.assertEqual(['foo.bar 3 1', 'foo.bar 4 1'], spool.read(10))
+        self.assertFalse(spool.pending())
+        self.assertEqual(1, len(os.listdir(self.directory)))
+        spool.append(['foo.bar 5 1'])
+        self.assertEqual(['foo.bar 5 1'], spool.read(10))
+
+    def test_evictOldestSegments(self):
+        spool = tcollector.DiskSpool(self.directory, 40, 20)
+        for i in xrange(5):
+            spool.append(['foo.bar %d 1' % i])
+        self.assertTrue(spool.bytes <= 40)
+        self.assertEqual(24, spool.bytes_evicted)
+        self.assertEqual(['foo.bar 2 1', 'foo.bar 3 1', 'foo.bar 4 1'],
+                         spool.read(10))
+        self.assertFalse(spool.append(['x' * 50]))
+
+    def test_recoverSegments(self):
+        spool = tcollector.DiskSpool(self.directory, 1000, 20)
+        spool.append(['foo.bar 0 1', 'foo.bar 1 1'])
+        spool.append(['foo.bar 2 1'])
+        spool = tcollector.DiskSpool(self.directory, 1000, 20)
+        self.assertTrue(spool.pending())
+        spool.append(['foo.bar 3 1'])
+        self.assertEqual(['foo.bar 0 1', 'foo.bar 1 1', 'foo.bar 2 1',
+                          'foo.bar 3 1'], spool.read(10))
+
+    def test_spoolWhenQueueIsFull(self):
+        readerq = tcollector.ReaderQueue(2)
+        readerq.spool = tcollector.DiskSpool(self.directory, 1000, 20)
+        self.assertEqual(3, readerq.nput_batch(['a', 'b', 'c']))
+        self.assertEqual(1, readerq.lines_spooled)
+        self.assertEqual(['c'], readerq.spool.read(10))
+
+
+class InternTableTests(unittest.TestCase):
+
+    def test_shareStrings(self):
+        table = tcollector.InternTable(4)
+        first = table(''.join(['foo', '.bar']))
+        second = table(''.join(['foo', '.bar']))
+        self.assertTrue(first is second)
+        self.assertEqual(1, table.hits)
+        self.assertEqual(1, table.misses)
+        self.assertEqual(50, table.hit_rate())
+        self.assertTrue(table.bytes_saved > 0)
+
+    def test_boundedSize(self):
+        table = tcollector.InternTable(4)
+        for i in xrange(10):
+            table('metric%d' % i)
+        self.assertTrue(len(table) <= 4)
+        # Recently used strings survive.
+        recent = table('metric9')
+        self.assertTrue(table('metric9') is recent)
+        self.assertEqual(2, table.hits)
+
+    def test_countPromotedOnce(self):
+        table = tcollector.InternTable(4)
+        for name in ('a', 'b', 'c', 'a', 'a'):
+            table(name)
+        self.assertEqual(3, len(table))
+
+
+class ShardingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tsds = [('tsd%d' % i, 4242) for i in xrange(3)]
+        self.sender = tcollector.ShardedSender(
+            tcollector.ReaderThread(300, 6000), False, self.tsds, False, {},
+            reconnectinterval=5)
+        for shard in self.sender.shards.itervalues():
+            shard.tsd = object()  # Pretend we're connected.
+
+    def test_ringIsConsistent(self):
+        ring = tcollector.HashRing(self.tsds)
+        owners = dict((i, ring.lookup('metric%d' % i).next())
+                      for i in xrange(1000))
+        # Every TSD gets its share of the series.
+        for tsd in self.tsds:
+            self.assertTrue(owners.values().count(tsd) > 200)
+        # Removing a TSD only moves the series it owned.
+        smaller = tcollector.HashRing(self.tsds[1:])
+        for i, owner in owners.iteritems():
+            if owner != self.tsds[0]:
+                self.assertEqual(owner, smaller.lookup('metric%d' % i).next())
+
+    def test_routeBySeries(self):
+        self.assertEqual(self.sender.route('foo.bar 1400000000 1 a=1 b=2'),
+                         self.sender.route('foo.bar 1400000015 2 b=2 a=1'))
+
+    def test_rerouteWhenShardIsDown(self):
+        line = 'foo.bar 1400000000 1 a=1'
+        owner = self.sender.route(line)
+        self.sender.dispatch([line])
+        self.sender.shards[owner].tsd = None
+        self.assertNotEqual(owner, self.sender.route(line))
+        self.sender.reroute()
+        self.assertEqual(0, self.sender.shards[owner].reader.readerq.qsize())
+        queued = sum(shard.reader.readerq.qsize()
+                     for shard in self.sender.shards.itervalues())
+        self.assertEqual(1, queued)
+
+    def test_splitQueueLimits(self):
+        reader = tcollector.ReaderThread(300, 6000)
+        reader.readerq.max_bytes = 3000
+        sender = tcollector.ShardedSender(reader, False, self.tsds, False, {},
+                                          reconnectinterval=5)
+        for shard in sender.shards.itervalues():
+            self.assertEqual(tcollector.MAX_READQ_SIZE // 3,
+                             shard.reader.readerq.maxsize)
+            self.assertEqual(1000, shard.reader.readerq.max_bytes)
+        owner = sender.route('foo.bar 1400000000 1')
+        sender.dispatch(['foo.bar 1400000000 %d' % i for i in xrange(100)])
+        dropped = sender.lines_dropped[owner]
+        self.assertTrue(dropped > 0)
+        self.assertEqual(dropped, sender.shards[owner].reader.lines_dropped)
+
+    def test_replaySpoolByRoute(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            spool = tcollector.DiskSpool(tmpdir, 1 << 20, 1 << 16)
+            sender = tcollector.ShardedSender(
+                tcollector.ReaderThread(300, 6000), False, self.tsds, False,
+                {}, reconnectinterval=5, spool=spool)
+            for shard in sender.shards.itervalues():
+                shard.tsd = object()
+                self.assertTrue(shard.spool is None)
+            lines = ['foo.bar%d 1400000000 1' % i for i in xrange(30)]
+            spool.append(lines)
+            sender.last_replay = 0
+            sender.replay_spool()
+            self.assertEqual(30, sender.lines_replayed)
+            queued = {}
+            for hostport, shard in sender.shards.iteritems():
+                for batch in shard.reader.readerq.get_batches(100):
+                    for line in batch:
+                        queued[line] = hostport
+            self.assertEqual(dict((line, sender.route(line))
+                                  for line in lines), queued)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class InProcessTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_collector(self, source):
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        self.assertTrue(tcollector.ThreadProc.supports(filename))
+        proc = tcollector.ThreadProc(tcollector.Collector('test.py', 0,
+                                                          filename))
+        status = proc.wait()
+        return status, proc.stdout.read(), proc.stderr.read()
+
+    def test_collect(self):
+        status, out, err = self.run_collector(
+            'import sys\n'
+            'def collect():\n'
+            '    yield "foo.bar 1400000000 1"\n'
+            '    yield "foo.bar 1400000015 2"\n'
+            'if __name__ == "__main__":\n'
+            '    sys.exit(1)\n')
+        self.assertEqual(0, status)
+        self.assertEqual('foo.bar 1400000000 1\nfoo.bar 1400000015 2\n', out)
+        self.assertEqual('', err)
+
+    def test_supportsIfstat(self):
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'collectors', '0', 'ifstat.py')
+        self.assertTrue(tcollector.ThreadProc.supports(filename))
+
+    def test_crashIsIsolated(self):
+        status, out, err = self.run_collector(
+            'def collect():\n'
+            '    yield "foo.bar 1400000000 1"\n'
+            '    raise ValueError("oops")\n')
+        self.assertEqual(1, status)
+        self.assertEqual('foo.bar 1400000000 1\n', out)
+        self.assertTrue('ValueError: oops' in err)
+
+    def test_exitCode(self):
+        status, out, err = self.run_collector(
+            'import sys\n'
+            'def collect():\n'
+            '    sys.exit(13)\n'
+            '    yield "never"\n')
+        self.assertEqual(13, status)
+
+    def test_killStuckThread(self):
+        filename = os.path.join(self.tmpdir, 'stuck.py')
+        with open(filename, 'w') as f:
+            f.write('def collect():\n'
+                    '    while True:\n'  # Until the pipe is full.
+                    '        yield "foo.bar 1400000000 1"\n')
+        col = tcollector.Collector('stuck.py', 0, filename)
+        proc = tcollector.ThreadProc(col)
+        time.sleep(0.1)
+        self.assertTrue(tcollector.ThreadProc.still_running(col))
+        tcollector.kill(proc, tcollector.signal.SIGKILL)
+        self.assertEqual(-tcollector.signal.SIGKILL, proc.poll())
+        # don't log that we can't start it again on every pass.
+        handler = ListHandler()
+        tcollector.LOG.addHandler(handler)
+        tcollector.IN_PROCESS = True
+        try:
+            tcollector.spawn_collector(col)
+            tcollector.spawn_collector(col)
+        finally:
+            tcollector.IN_PROCESS = False
+            tcollector.LOG.removeHandler(handler)
+        self.assertEqual(1, len([message for message in handler.messages
+                                 if 'still running' in message]))
+        proc.thread.join(5)
+        self.assertFalse(tcollector.ThreadProc.still_running(col))
+
+    def test_subprocessCollectors(self):
+        self.assertFalse(tcollector.ThreadProc.supports(
+            os.path.join(os.path.dirname(__file__), 'collectors', '0',
+                         'opentsdb.sh')))
+
+
+class ForkServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = tcollector.ForkServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def spawn(self, source):
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        return self.server.spawn(tcollector.Collector('test.py', 1, filename))
+
+    def read(self, f):
+        data = ''
+        while True:
+            tcollector.select.select([f], [], [])
+            buf = os.read(f.fileno(), 4096)
+            if not buf:
+                return data
+            data += buf
+
+    def test_spawn(self):
+        proc = self.spawn('print "foo.bar 1400000000 1"\n')
+        self.assertEqual('foo.bar 1400000000 1\n', self.read(proc.stdout))
+        self.assertEqual(0, proc.wait())
+
+    def test_status(self):
+        proc = self.spawn('import sys\n'
+                          'sys.stderr.write("bye")\n'
+                          'sys.exit(13)\n')
+        self.assertEqual('bye', self.read(proc.stderr))
+        self.assertEqual(13, proc.wait())
+        proc = self.spawn('import time\ntime.sleep(60)\n')
+        tcollector.kill(proc)
+        self.assertEqual(-tcollector.signal.SIGTERM, proc.wait())
+
+    def test_usage(self):
+        proc = self.spawn('import time\n'
+                          'end = time.time() + 0.2\n'
+                          'while time.time() < end:\n'
+                          '    pass\n')
+        self.assertEqual(0, proc.wait())
+        cpu, rss, read_bytes = proc.usage
+        self.assertTrue(cpu >= 0.1)
+        self.assertTrue(rss > 0)
+        usage = tcollector.ResourceUsage()
+        usage.start(proc)
+        usage.finish(proc.usage)
+        self.assertEqual(cpu, usage.totals()[0])
+
+    def test_forkserverDied(self):
+        col = tcollector.Collector('test.py', 1, 'test.py')
+        col.proc = self.spawn('import time\ntime.sleep(60)\n')
+        os.kill(self.server.pid, tcollector.signal.SIGKILL)
+        tcollector.FORKSERVER = self.server
+        collectors = tcollector.COLLECTORS
+        try:
+            tcollector.COLLECTORS = {'test.py': col}
+            tcollector.wait_for_children(5)
+            self.assertEqual(None, tcollector.FORKSERVER)
+            self.assertEqual(0, col.proc.poll())
+            tcollector.reap_children()
+            self.assertEqual(None, col.proc)
+        finally:
+            tcollector.FORKSERVER = None
+            tcollector.COLLECTORS = collectors
+
+    def test_fallbackToSubprocess(self):
+        class FailingServer(object):
+            def spawn(self, col, cgroup=None):
+                raise OSError(tcollector.errno.EIO, 'No such file')
+
+        filename = os.path.join(self.tmpdir, 'test.py')
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\necho foo.bar 1400000000 1\n')
+        os.chmod(filename, 0755)
+        col = tcollector.Collector('test.py', 1, filename)
+        saved = tcollector.FORKSERVER
+        tcollector.FORKSERVER = FailingServer()
+        try:
+            tcollector.spawn_collector(col)
+        finally:
+            tcollector.FORKSERVER = saved
+        self.assertTrue(isinstance(col.proc, tcollector.subprocess.Popen))
+        self.assertEqual(0, col.proc.wait())
+        self.assertEqual('foo.bar 1400000000 1\n', col.proc.stdout.read())
+
+
+class SchedulingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS
+        self.schedule = tcollector.SCHEDULE
+        tcollector.COLLECTORS = {}
+        tcollector.SCHEDULE = []
+
+    def tearDown(self):
+        tcollector.COLLECTORS = self.collectors
+        tcollector.SCHEDULE = self.schedule
+        tcollector.SCHEDULE_MODE = 'interval'
+
+    def test_nextSpawnTime(self):
+        tcollector.register_collector(
+            tcollector.Collector('a.py', 30, 'a.py', lastspawn=1000))
+        self.assertEqual(tcollector.COLLECTORS['a.py'].next_run,
+                         tcollector.next_spawn_time())
+        tcollector.register_collector(
+            tcollector.Collector('b.py', 0, 'b.py', lastspawn=1010))
+        self.assertEqual(1010 + tcollector.MIN_RESPAWN_INTERVAL,
+                         tcollector.next_spawn_time())
+
+    def test_failedSpawnWaits(self):
+        col = tcollector.Collector('missing', 0, '/nonexistent/missing')
+        tcollector.register_collector(col)
+        tcollector.spawn_collector(col)
+        self.assertEqual(None, col.proc)
+        self.assertTrue(tcollector.next_spawn_time() > time.time())
+
+    def test_keepScheduleWhenReset(self):
+        tcollector.register_collector(tcollector.Collector('a.py', 30, 'a.py'))
+        tcollector.schedule_collector(tcollector.COLLECTORS['a.py'], 1234)
+        tcollector.register_collector(tcollector.Collector('a.py', 30, 'a.py'))
+        self.assertEqual(1234, tcollector.COLLECTORS['a.py'].next_run)
+        self.assertEqual(1234, tcollector.next_spawn_time())
+
+    def test_alignedSchedule(self):
+        tcollector.SCHEDULE_MODE = 'aligned'
+        col = tcollector.Collector('a.py', 60, 'a.py')
+        when = tcollector.first_run_time(col)
+        self.assertEqual(0, when % 60)
+        self.assertTrue(0 < when - time.time() <= 60)
+        self.assertEqual(when + 60, tcollector.next_run_time(col, when))
+
+    def test_jitteredSchedule(self):
+        tcollector.SCHEDULE_MODE = 'jittered'
+        col = tcollector.Collector('a.py', 60, 'a.py')
+        offset = tcollector.schedule_offset(col)
+        self.assertTrue(0 <= offset < 60)
+        self.assertEqual(offset, tcollector.schedule_offset(
+            tcollector.Collector('a.py', 60, 'a.py')))
+        when = tcollector.first_run_time(col)
+        self.assertAlmostEqual(offset, when % 60, places=3)
+        self.assertAlmostEqual(when + 60, tcollector.next_run_time(col, when),
+                               places=3)
+
+    def test_waitForChildren(self):
+        tcollector.setup_wakeup_pipe()
+        try:
+            start = time.time()
+            tcollector.wakeup_main_loop()
+            tcollector.wait_for_children(10)
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            tcollector.signal.set_wakeup_fd(-1)
+            tcollector.signal.signal(tcollector.signal.SIGCHLD,
+                                     tcollector.signal.SIG_DFL)
+            for fd in tcollector.WAKEUP_PIPE:
+                os.close(fd)
+            tcollector.WAKEUP_PIPE = None
+
+
+class ResourceUsageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.collectors = tcollector.COLLECTORS
+        tcollector.COLLECTORS = {}
+
+    def tearDown(self):
+        tcollector.COLLECTORS = self.collectors
+
+    def test_processStats(self):
+        if not os.path.exists('/proc/self/stat'):
+            self.skipTest('no /proc')
+        stats = tcollector.ProcessStats(os.getpid())
+        cpu, rss, read_bytes = stats.read()
+        self.assertTrue(cpu > 0)
+        self.assertTrue(rss > 0)
+        stats.close()
+
+    def test_usageOfExitedProcesses(self):
+        if not os.path.exists('/proc/self/stat'):
+            self.skipTest('no /proc')
+        col = tcollector.Collector('test', 0, 'test')
+        tcollector.register_collector(col)
+        proc = tcollector.subprocess.Popen(['sleep', '0.1'])
+        col.usage.start(proc)
+        proc.wait()
+        col.usage.finish()
+        # the Collector gets registered again when its process exits.
+        tcollector.register_collector(tcollector.Collector('test', 0, 'test'))
+        usage = tcollector.COLLECTORS['test'].usage
+        self.assertEqual(1, usage.spawn_count)
+        cpu, rss, read_bytes, runtime = usage.totals()
+        self.assertEqual(0, rss)
+        self.assertTrue(runtime >= 0.1)
+
+
+class CgroupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'cgroup.controllers'), 'w') as f:
+            f.write('cpuset cpu io memory pids\n')
+        self.cgroups = tcollector.CgroupManager(self.root, 0.5, 64 << 20)
+        self.col = tcollector.Collector('smart-stats.py', 0, 'smart-stats.py')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, *path):
+        return open(os.path.join(self.root, *path)).read()
+
+    def test_limits(self):
+        self.assertEqual('+cpu +memory', self.read('cgroup.subtree_control'))
+        path = self.cgroups.setup(self.col)
+        self.assertEqual(os.path.join(self.root, 'smart-stats.py'), path)
+        self.assertEqual('50000 100000', self.read(path, 'cpu.max'))
+        self.assertEqual(str(64 << 20), self.read(path, 'memory.max'))
+
+    def test_skipInProcess(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'inproc.py')
+        with open(filename, 'w') as f:
+            f.write('def collect():\n    yield "foo.bar 1400000000 1"\n')
+        col = tcollector.Collector('inproc.py', 0, filename)
+        tcollector.CGROUPS = self.cgroups
+        tcollector.IN_PROCESS = True
+        try:
+            tcollector.spawn_collector(col)
+            self.assertEqual(0, col.proc.wait())
+        finally:
+            tcollector.CGROUPS = None
+            tcollector.IN_PROCESS = False
+            shutil.rmtree(tmpdir)
+        self.assertFalse(os.path.exists(self.cgroups.path(col)))
+
+    def test_stats(self):
+        path = self.cgroups.setup(self.col)
+        with open(os.path.join(path, 'cpu.stat'), 'w') as f:
+            f.write('usage_usec 1000\nnr_periods 10\nnr_throttled 3\n'
+                    'throttled_usec 4500\n')
+        with open(os.path.join(path, 'memory.events'), 'w') as f:
+            f.write('low 0\nhigh 0\nmax 7\noom 1\noom_kill 1\n')
+        with open(os.path.join(path, 'memory.current'), 'w') as f:
+            f.write('123456\n')
+        self.assertEqual([('cgroup.nr_throttled', 3),
+                          ('cgroup.throttled_usec', 4500),
+                          ('cgroup.memory_current', 123456),
+                          ('cgroup.memory_max_events', 7),
+                          ('cgroup.oom_kills', 1)],
+                         self.cgroups.stats(self.col))
+
+
+class ListHandler(logging.Handler):
+    """Keeps the messages logged, once the gate is open."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(self.format(record))
+
+
+class StderrLoggingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        tcollector.LOG.addHandler(self.handler)
+
+    def tearDown(self):
+        tcollector.LOG.removeHandler(self.handler)
+
+    def test_tokenBucket(self):
+        bucket = tcollector.TokenBucket(2, 3)
+        now = bucket.last
+        self.assertEqual([True, True, True, False],
+                         [bucket.consume(now) for i in range(4)])
+        self.assertTrue(bucket.consume(now + 0.5))
+        self.assertFalse(bucket.consume(now + 0.5))
+        # the tokens don't pile up above the burst.
+        self.assertEqual(3, sum(bucket.consume(now + 100) for i in range(4)))
+
+    def test_suppressed(self):
+        col = tcollector.Collector('mysql.py', 0, 'mysql.py')
+        col.stderr_bucket = tcollector.TokenBucket(1, 2)
+        for i in range(5):
+            col.log_stderr('error %d' % i)
+        self.assertEqual(['mysql.py: error 0', 'mysql.py: error 1'],
+                         self.handler.messages)
+        col.log_suppressed()
+        self.assertEqual('mysql.py: 3 messages suppressed',
+                         self.handler.messages[-1])
+        col.log_suppressed()
+        self.assertEqual(3, len(self.handler.messages))
+
+    def test_asyncHandler(self):
+        target = ListHandler()
+        target.gate.clear()  # The disk is stuck.
+        handler = tcollector.AsyncLogHandler(target, maxsize=5)
+        for i in range(20):
+            handler.handle(logging.makeLogRecord({'msg': 'line %d',
+                                                  'args': (i,)}))
+        target.gate.set()
+        handler.flush()
+        lines = [m for m in target.messages if m.startswith('line')]
+        dropped = sum(int(m.split()[0]) for m in target.messages
+                      if m.endswith('log messages dropped'))
+        self.assertEqual('line 0', target.messages[0])
+        self.assertTrue(len(lines) <= 10, target.messages)
+        self.assertEqual(20, len(lines) + dropped)
+        handler.close()
+
+
+class ReaderPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = tcollector.ReaderPoller()
+        self.readers = []
+        self.writers = []
+
+    def tearDown(self):
+        for f in self.readers:
+            f.close()
+        for fd in self.writers:
+            try:
+                os.close(fd)
+            except OSError:
+                pass  # Closed by the test.
+
+    def collector(self, name):
+        """Returns a Collector with pipes as its stdout and stderr, and the
+           write ends of those pipes."""
+        class Proc(object):
+            pass
+
+        col = tcollector.Collector(name, 0, name)
+        col.proc = Proc()
+        writers = []
+        for stream in ('stdout', 'stderr'):
+            r, w = os.pipe()
+            f = os.fdopen(r, 'rb', 0)
+            setattr(col.proc, stream, f)
+            self.readers.append(f)
+            writers.append(w)
+        self.writers.extend(writers)
+        return col, writers
+
+    def test_readable(self):
+        foo, foo_writers = self.collector('foo')
+        bar, bar_writers = self.collector('bar')
+        self.poller.register(foo)
+        self.poller.register(bar)
+        os.write(foo_writers[0], 'foo.bar 1400000000 1\n')
+        self.assertEqual([foo], list(self.poller.poll(1)))
+        os.write(bar_writers[1], 'oops\n')
+        self.assertEqual([foo, bar], list(self.poller.poll(1)))
+
+    def test_unregister(self):
+        col, writers = self.collector('foo')
+        self.poller.register(col)
+        self.poller.unregister(col)
+        self.assertEqual({}, self.poller.fds)
+        os.write(writers[0], 'foo.bar 1400000000 1\n')
+        self.assertEqual([], list(self.poller.poll(0.1)))
+
+    def test_hangup(self):
+        col, writers = self.collector('foo')
+        self.poller.register(col)
+        os.close(writers[0])
+        self.assertEqual([col], list(self.poller.poll(1)))
+        self.assertEqual([col.proc.stderr.fileno()], self.poller.fds.keys())
+        self.assertEqual('', col.proc.stdout.read())
+
+    def test_reapAfterEOF(self):
+        col = tcollector.Collector('burst', 0, 'burst')
+        col.proc = tcollector.subprocess.Popen(
+            ['seq', '3000'], stdout=tcollector.subprocess.PIPE,
+            stderr=tcollector.subprocess.PIPE)
+        self.readers.extend((col.proc.stdout, col.proc.stderr))
+        tcollector.set_nonblocking(col.proc.stdout.fileno())
+        tcollector.set_nonblocking(col.proc.stderr.fileno())
+        self.poller.register(col)
+        collectors = tcollector.COLLECTORS
+        tcollector.POLLER = self.poller
+        tcollector.COLLECTORS = {'burst': col}
+        try:
+            while col.proc.poll() is None:
+                time.sleep(0.01)
+            # nothing was read yet, the collector must not be dropped.
+            tcollector.reap_children()
+            self.assertNotEqual(None, col.proc)
+            lines = []
+            while self.poller.watching(col):
+                for ready in self.poller.poll(1):
+                    lines.extend(ready.collect())
+            tcollector.reap_children()
+            self.assertEqual(None, col.proc)
+        finally:
+            tcollector.POLLER = None
+            tcollector.COLLECTORS = collectors
+        self.assertEqual(map(str, xrange(1, 3001)), lines)
+
+    def test_wakeup(self):
+        col, writers = self.collector('foo')
+        self.poller.register(col)
+        self.poller.wakeup()
+        self.poller.wakeup()
+        start = time.time()
+        self.assertEqual([], list(self.poller.poll(5)))
+        self.assertTrue(time.time() - start < 1)
+        # the wakeup pipe got drained.
+        self.assertEqual([], list(self.poller.poll(0.1)))
+
+
+class LineBufferTests(unittest.TestCase):
+
+    def fill(self, buf, *chunks):
+        r, w = os.pipe()
+        try:
+            tcollector.set_nonblocking(r)
+            f = tcollector.io.FileIO(r, 'r', closefd=False)
+            for chunk in chunks:
+                os.write(w, chunk)
+                buf.fill(f)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_severalLines(self):
+        buf = tcollector.LineBuffer(64)
+        self.fill(buf, 'a 1 1\nb 1 1\nc 1 1\n')
+        self.assertEqual(['a 1 1', 'b 1 1', 'c 1 1'], buf.lines())
+        self.assertEqual(0, len(buf))
+        self.assertEqual([], buf.lines())
+
+    def test_partialLine(self):
+        buf = tcollector.LineBuffer(64)
+        self.fill(buf, 'a 1 1\nb 1')
+        self.assertEqual(['a 1 1'], buf.lines())
+        self.assertEqual(3, len(buf))
+        self.assertEqual([], buf.lines())
+        self.fill(buf, ' 1\nc')
+        self.assertEqual(['b 1 1'], buf.lines())
+        self.assertEqual(1, len(buf))
+
+    def test_crlf(self):
+        buf = tcollector.LineBuffer(64)
+        self.fill(buf, 'a 1 1\r\nb 1 1\r', '\n')
+        self.assertEqual(['a 1 1\r', 'b 1 1\r'], buf.lines())
+
+        # the '\r' goes away with the spaces in Collector.read.
+        class Proc(object):
+            pass
+
+        col = tcollector.Collector('test', 0, 'test')
+        col.proc = Proc()
+        fds = os.pipe() + os.pipe()
+        try:
+            for fd in fds:
+                tcollector.set_nonblocking(fd)
+            col.proc.stdout = os.fdopen(fds[0], 'rb', 0)
+            col.proc.stderr = os.fdopen(fds[2], 'rb', 0)
+            os.write(fds[1], 'c 1 1\r\n')
+            col.read()
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.assertEqual(['c 1 1'], col.datalines)
+
+    def test_growAndCompact(self):
+        buf = tcollector.LineBuffer(16)
+        # a partial line that doesn't fit makes the buffer grow.
+        self.fill(buf, 'x' * 40)
+        self.assertEqual([], buf.lines())
+        self.assertTrue(len(buf.buf) >= 40)
+        self.fill(buf, '\n')
+        self.assertEqual(['x' * 40], buf.lines())
+        size = len(buf.buf)
+        # small partial lines get moved back to the front instead.
+        self.fill(buf, 'b')
+        for i in xrange(100):
+            self.fill(buf, ' %d' % i, ' 1\nb')
+            self.assertEqual(['b %d 1' % i], buf.lines())
+        self.assertEqual(size, len(buf.buf))
+        self.assertEqual(1, len(buf))
+
+
+class DirectoryWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.cdir, '0'))
+        os.mkdir(os.path.join(self.cdir, 'etc'))
+        self.watcher = tcollector.DirectoryWatcher.create(self.cdir)
+        if self.watcher is None:
+            self.skipTest('inotify is not available')
+
+    def tearDown(self):
+        if self.watcher is not None:
+            os.close(self.watcher.fileno())
+        shutil.rmtree(self.cdir)
+
+    def touch(self, *path):
+        open(os.path.join(self.cdir, *path), 'w').close()
+
+    def test_noChanges(self):
+        self.assertEqual((False, False), self.watcher.read())
+
+    def test_changes(self):
+        self.touch('0', 'foo.py')
+        self.assertEqual((True, False), self.watcher.read())
+        self.touch('etc', 'config.py')
+        self.assertEqual((False, True), self.watcher.read())
+
+    def test_newIntervalDirectory(self):
+        os.mkdir(os.path.join(self.cdir, '30'))
+        self.assertEqual((True, False), self.watcher.read())
+        self.touch('30', 'foo.py')
+        self.assertEqual((True, False), self.watcher.read())
+
+
 class UDPCollectorTests(unittest.TestCase):
 
     def setUp(self):